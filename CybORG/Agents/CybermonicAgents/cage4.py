@@ -1,41 +1,64 @@
+from contextlib import nullcontext
+
 import torch
 from torch import nn
 from torch.optim import Adam
 from torch.distributions.categorical import Categorical
 from torch_geometric.nn import GCNConv
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
 
 from CybORG.Agents.CybermonicAgents.memory_buffer import MultiPPOMemory
-from CybORG.Agents.CybermonicAgents.utils import combine_marl_states
+from CybORG.Agents.CybermonicAgents.utils import combine_marl_states, discount, gae, vtrace
 
 MAX_SERVERS = 6
 MAX_USERS = 10
 MAX_EDGES = 8
 
 
-def pad_sequence(seq, lens, padding):
-    padded = torch.zeros(lens.size(0), padding, seq.size(-1))
-    mask = torch.ones(padded.size(0), padded.size(1))
-
-    offset = 0
-    for i,len in enumerate(lens):
-        st = offset
-        en = offset+len
+def _pad_masks(n_servers, n_users):
+    '''
+    Which of the MAX_SERVERS + MAX_USERS host slots are real hosts.
+    Just a comparison, so cheaper to redo every call than to cache 
+    (and no .tolist() to break up torch.compile graphs)
+    '''
+    s_mask = torch.arange(MAX_SERVERS).unsqueeze(0) < n_servers.unsqueeze(1)
+    u_mask = torch.arange(MAX_USERS).unsqueeze(0) < n_users.unsqueeze(1)
+    return s_mask, u_mask
 
-        padded[i][:len] = seq[st:en]
-        mask[i][len:] = 0
-        offset += len
+def normalize_edges(ei, n):
+    '''
+    Adds self loops and symmetric degree normalization to ei, the same as
+    GCNConv does by default. Returns the new edge index and edge weights.
+    InductiveGraphPPOAgent._forward calls this once per state and hands
+    the result to both conv layers of the actor and the critic
+    '''
+    return gcn_norm(ei, num_nodes=n)
 
-    return padded, mask.unsqueeze(-1)
+def host_index(servers, n_servers, users, n_users):
+    '''
+    Build the index extract_hosts uses to pull every host out of x
+    in a single gather. Only depends on the masks, not on x, so it 
+    can be computed once and reused for every layer
+    '''
+    s_mask, u_mask = _pad_masks(n_servers, n_users)
 
-def extract_hosts(x, servers, n_servers, users, n_users):
-    srv = x[servers]
-    srv,s_mask = pad_sequence(srv, n_servers, MAX_SERVERS)  # B x MAX_s x d
+    # Padding slots point at node 0, but get zeroed out by the mask
+    s_idx = torch.zeros(s_mask.size(), dtype=torch.long)
+    s_idx[s_mask] = servers
+    u_idx = torch.zeros(u_mask.size(), dtype=torch.long)
+    u_idx[u_mask] = users
 
-    usr = x[users]
-    usr,u_mask = pad_sequence(usr, n_users, MAX_USERS)      # B x MAX_u x d
+    idx = torch.cat([s_idx, u_idx], dim=1)                        # B x 16
+    mask = torch.cat([s_mask, u_mask], dim=1).float().unsqueeze(-1) # B x 16 x 1
+    return idx, mask
 
-    hosts = torch.cat([srv,usr], dim=1)
-    mask = torch.cat([s_mask, u_mask], dim=1)
+def extract_hosts(x, idx, mask):
+    '''
+    Args: 
+        x: N x d node features 
+        idx, mask: output of host_index
+    '''
+    hosts = x[idx] * mask   # B x 16 x d
     return hosts, mask
 
 class SimpleSelfAttention(nn.Module):
@@ -83,8 +106,9 @@ class InductiveActorNetwork(nn.Module):
                  hidden1=256, hidden2=64, gdim=64, lr=0.0003, concat_edges=False):
         super().__init__()
 
-        self.conv1 = GCNConv(in_dim, hidden1)
-        self.conv2 = GCNConv(hidden1, hidden2)
+        # Normalization is done once up front by normalize_edges
+        self.conv1 = GCNConv(in_dim, hidden1, normalize=False)
+        self.conv2 = GCNConv(hidden1, hidden2, normalize=False)
 
         self.g0_attn = SimpleSelfAttention(in_dim, hidden1, gdim)
         self.g1_attn = SimpleSelfAttention(hidden1, hidden1, gdim)
@@ -125,8 +149,20 @@ class InductiveActorNetwork(nn.Module):
 
         self.node_action_space = node_action_space
         self.edge_action_space = edge_action_space
+        self.gdim = gdim
 
-    def forward(self, x, ei, global_vec, servers, n_servers, users, n_users, action_edges, multi_subnet):
+    def forward(self, x, ei, global_vec, servers, n_servers, users, n_users, action_edges, multi_subnet, ew=None):
+        return self.decode(*self.encode(
+            x, ei, global_vec, servers, n_servers, users, n_users, action_edges, multi_subnet, ew=ew
+        ))
+
+    def encode(self, x, ei, global_vec, servers, n_servers, users, n_users, action_edges, multi_subnet, ew=None):
+        '''
+        Message passing part of the network. Returns node embeddings, and 
+        the global vector (plus what decode needs to pick hosts/edges back out)
+
+        If ew is given, ei is assumed to already be the output of normalize_edges
+        '''
         # Always come in groups of 9
         rtrs = action_edges.unique(sorted=True).squeeze(-1)
         bs = rtrs.size(0) // 9
@@ -135,34 +171,43 @@ class InductiveActorNetwork(nn.Module):
             rtrs = rtrs.repeat_interleave(3,0)
 
         rtr_mask = torch.ones(rtrs.size(0), 9, 1)
+        hosts = host_index(servers, n_servers, users, n_users)
+        if ew is None:
+            ei,ew = normalize_edges(ei, x.size(0))
 
         # Global init features
         g0 = self.global_net(global_vec)
 
-        v,mask = extract_hosts(x, servers, n_servers, users, n_users)
+        v,mask = extract_hosts(x, *hosts)
         rtr = x[rtrs]
         v = torch.cat([v, rtr], dim=1)
         mask = torch.cat([mask, rtr_mask], dim=1)
         g = self.g0_attn(v,mask, g=g0)
 
         # Layer 1
-        x = torch.relu(self.conv1(x, ei))
-        v,mask = extract_hosts(x, servers, n_servers, users, n_users)
+        x = torch.relu(self.conv1(x, ei, ew))
+        v,mask = extract_hosts(x, *hosts)
         rtr = x[rtrs]
         v = torch.cat([v, rtr], dim=1)
         mask = torch.cat([mask, rtr_mask], dim=1)
         g = self.g1_attn(v,mask, g=g)
 
         # Layer 2
-        x = torch.relu(self.conv2(x, ei))
-        v,mask = extract_hosts(x, servers, n_servers, users, n_users)
+        x = torch.relu(self.conv2(x, ei, ew))
+        v,mask = extract_hosts(x, *hosts)
         rtr = x[rtrs]
         v = torch.cat([v, rtr], dim=1)
         mask = torch.cat([mask, rtr_mask], dim=1)
         g = self.g2_attn(v,mask, g=g) # B x d_g
 
+        return x, g, hosts, action_edges, multi_subnet
+
+    def decode(self, x, g, hosts, action_edges, multi_subnet):
+        '''
+        Action distribution from the output of encode
+        '''
         # B x 16 x d
-        z,mask = extract_hosts(x, servers, n_servers, users, n_users)
+        z,mask = extract_hosts(x, *hosts)
 
         # Attach global vec to all nodes in each batch
         z = torch.cat(
@@ -219,6 +264,7 @@ class InductiveActorNetwork(nn.Module):
         if multi_subnet:
             out = out.reshape(out.size(0)//3, out.size(1)*3)
 
+        out = out.float()               # In case of autocast
         out[out == 0] = -float('inf')   # So softmax prob is 0
         out = self.sm(out)
 
@@ -230,8 +276,9 @@ class InductiveCriticNetwork(nn.Module):
                  hidden1=256, hidden2=64, gdim=64, lr=0.001):
         super().__init__()
 
-        self.conv1 = GCNConv(in_dim, hidden1)
-        self.conv2 = GCNConv(hidden1, hidden2)
+        # Normalization is done once up front by normalize_edges
+        self.conv1 = GCNConv(in_dim, hidden1, normalize=False)
+        self.conv2 = GCNConv(hidden1, hidden2, normalize=False)
         self.out = nn.Sequential(
             nn.Linear(hidden2, hidden1),
             nn.ReLU(),
@@ -254,18 +301,21 @@ class InductiveCriticNetwork(nn.Module):
         )
         self.opt = Adam(self.parameters(), lr)
 
-    def forward(self, x, ei, global_vec, servers, n_servers, users, n_users, action_edges, multi_subnet):
+    def forward(self, x, ei, global_vec, servers, n_servers, users, n_users, action_edges, multi_subnet, ew=None):
         g0 = self.gs(global_vec)
+        hosts = host_index(servers, n_servers, users, n_users)
+        if ew is None:
+            ei,ew = normalize_edges(ei, x.size(0))
 
-        v,mask = extract_hosts(x, servers, n_servers, users, n_users)
+        v,mask = extract_hosts(x, *hosts)
         g = self.g0_attn(v, mask, g=g0)
 
-        x = torch.relu(self.conv1(x, ei))
-        v,mask = extract_hosts(x, servers, n_servers, users, n_users)
+        x = torch.relu(self.conv1(x, ei, ew))
+        v,mask = extract_hosts(x, *hosts)
         g = self.g1_attn(v, mask, g=g)
 
-        x = torch.relu(self.conv2(x, ei))
-        v,mask = extract_hosts(x, servers, n_servers, users, n_users)
+        x = torch.relu(self.conv2(x, ei, ew))
+        v,mask = extract_hosts(x, *hosts)
         g = self.g2_attn(v, mask, g=g)
 
         # I guess just average the three global vectors together?
@@ -273,7 +323,31 @@ class InductiveCriticNetwork(nn.Module):
             g = g.reshape(g.size(0) // 3, 3, g.size(-1))
             g = g.mean(dim=1)
 
-        return self.out(g)
+        return self.out(g).float()
+
+
+class CriticHead(nn.Module):
+    '''
+    Value head for when the critic shares the actor's message passing
+    layers (InductiveGraphPPOAgent(shared_trunk=True)). Works on the 
+    global vector from InductiveActorNetwork.encode
+    '''
+    def __init__(self, gdim=64, lr=0.001):
+        super().__init__()
+
+        self.out = nn.Sequential(
+            nn.Linear(gdim, gdim//2),
+            nn.ReLU(),
+            nn.Linear(gdim//2, 1)
+        )
+        self.opt = Adam(self.parameters(), lr)
+
+    def forward(self, g, multi_subnet):
+        if multi_subnet:
+            g = g.reshape(g.size(0) // 3, 3, g.size(-1))
+            g = g.mean(dim=1)
+
+        return self.out(g).float()
 
 
 class InductiveGraphPPOAgent():
@@ -283,16 +357,40 @@ class InductiveGraphPPOAgent():
     which action to take
     '''
     def __init__(self, in_dim, gamma=0.99, lmbda=0.95, clip=0.1, bs=5, epochs=6,
-                 a_kwargs=dict(), c_kwargs=dict(), training=True, concat_edges=False):
+                 a_kwargs=dict(), c_kwargs=dict(), training=True, concat_edges=False, gae=False,
+                 vtrace=False, amp=False, compiled=False, shared_trunk=False, mirror_symmetric=False):
 
         self.actor = InductiveActorNetwork(in_dim, concat_edges=concat_edges, **a_kwargs)
-        self.critic = InductiveCriticNetwork(in_dim, **c_kwargs)
+
+        # Critic can either have its own GNN, or just be a head on top of
+        # the actor's so each state only gets encoded once. Critic loss 
+        # backprops into the shared layers (which the actor's opt updates)
+        if shared_trunk:
+            # Hidden sizes come from the actor, so lr is all that's left to set
+            unused = set(c_kwargs) - {'lr'}
+            if unused:
+                raise ValueError(f'shared_trunk critic only takes lr, got c_kwargs {sorted(unused)}')
+            self.critic = CriticHead(gdim=self.actor.gdim, **c_kwargs)
+        else:
+            self.critic = InductiveCriticNetwork(in_dim, **c_kwargs)
         self.memory = MultiPPOMemory(bs, agents=5)
 
+        # Compile forward passes. Patching methods (rather than wrapping 
+        # the modules) keeps state_dict keys the same, so checkpoints 
+        # load either way. Only worth it for big learn() minibatches, 
+        # first call per shape takes 20-60s to compile. Check it against
+        # eager with cybermonic_benchmark.py --check
+        if compiled:
+            self.actor.encode = torch.compile(self.actor.encode, dynamic=True)
+            self.actor.decode = torch.compile(self.actor.decode, dynamic=True)
+            self.critic.forward = torch.compile(self.critic.forward, dynamic=True)
+
         self.args = (in_dim,)
         self.kwargs = dict(
             gamma=gamma, lmbda=lmbda, clip=clip, bs=bs, epochs=epochs,
-            a_kwargs=a_kwargs, c_kwargs=c_kwargs, training=training, concat_edges=concat_edges
+            a_kwargs=a_kwargs, c_kwargs=c_kwargs, training=training, concat_edges=concat_edges,
+            gae=gae, vtrace=vtrace, amp=amp, compiled=compiled, shared_trunk=shared_trunk,
+            mirror_symmetric=mirror_symmetric
         )
 
         # PPO Hyperparams
@@ -302,6 +400,23 @@ class InductiveGraphPPOAgent():
         self.bs = bs
         self.epochs = epochs
 
+        # Use GAE(lmbda) advantages instead of normalized discounted returns - V
+        self.gae = gae
+
+        # Use V-trace targets to correct for memories generated by an older
+        # policy (e.g. from async rollout workers). Takes priority over gae
+        self.vtrace = vtrace
+
+        # Run actor/critic in bfloat16 autocast (outputs are still float32)
+        self.amp = amp
+        self.shared_trunk = shared_trunk
+
+        # Trained on GraphWrapper(mirror_symmetric=True) observations (i.e.
+        # with --share-weights). Doesn't change the agent itself, but it's
+        # saved with the checkpoint so whatever evaluates it can build 
+        # the same wrapper
+        self.mirror_symmetric = mirror_symmetric
+
         self.training = training
         self.deterministic = False
         self.mse = nn.MSELoss()
@@ -329,6 +444,32 @@ class InductiveGraphPPOAgent():
         self.actor.eval()
         self.critic.eval()
 
+    def _autocast(self):
+        if self.amp:
+            return torch.autocast('cpu', dtype=torch.bfloat16)
+        return nullcontext()
+
+    def _forward(self, state, critic=True):
+        '''
+        Actor's action distribution, and the critic's value for state 
+        (or None if critic=False). 
+        '''
+        # Normalize edges once for every conv layer of both networks
+        x, ei, *rest = state
+        ei, ew = normalize_edges(ei, x.size(0))
+        state = (x, ei, *rest)
+
+        with self._autocast():
+            if not self.shared_trunk:
+                dist = self.actor(*state, ew=ew)
+                value = self.critic(*state, ew=ew) if critic else None
+                return dist, value
+
+            x, g, *rest = self.actor.encode(*state, ew=ew)
+            dist = self.actor.decode(x, g, *rest)
+            value = self.critic(g, state[-1]) if critic else None
+            return dist, value
+
     def _zero_grad(self):
         '''
         Reset opt
@@ -372,7 +513,7 @@ class InductiveGraphPPOAgent():
         if is_blocked:
             return None
 
-        distro = self.actor(*state)
+        distro,value = self._forward(state, critic=self.training)
 
         # I don't know why this would ever be called
         # during training, but just in case, putting the
@@ -385,10 +526,38 @@ class InductiveGraphPPOAgent():
         if not self.training:
             return action.item()
 
-        value = self.critic(*state)
         prob = distro.log_prob(action)
         return action.item(), value.item(), prob.item()
 
+    @torch.no_grad()
+    def get_actions(self, states):
+        '''
+        Batched version of get_action. All states are combined into 
+        one graph, so the actor (and critic, if training) are only 
+        called once no matter how many states there are. 
+
+        Args: 
+            states: list of states from GraphWrapper (without is_blocked). 
+                    Must all be multi-subnet or all single-subnet 
+
+        If eval(), returns a list of actions
+        If train() returns a list of (action, value, log prob)
+        '''
+        batch = combine_marl_states(states)
+        distro,value = self._forward(batch, critic=self.training)
+
+        if self.deterministic:
+            action = distro.probs.argmax(dim=-1)
+        else:
+            action = distro.sample()
+
+        if not self.training:
+            return action.tolist()
+
+        value = value.squeeze(-1)
+        prob = distro.log_prob(action)
+        return list(zip(action.tolist(), value.tolist(), prob.tolist()))
+
     def remember(self, idx, s, a, v, p, r, t):
         '''
         Save an observation to the agent's memory buffer
@@ -400,44 +569,51 @@ class InductiveGraphPPOAgent():
         This runs the PPO update algorithm on memories stored in self.memory 
         Assumes that an external process is adding memories to the buffer
         '''
-        for e in range(self.epochs):
-            s,a,v,p,r,t, batches = self.memory.get_batches()
-
+        s,a,v,p,r,t,batches = self.memory.get_batches()
+        a = torch.tensor(a)
+        p = torch.tensor(p)
+
+        # Returns don't change between epochs, so only calculate them once
+        if self.vtrace:
+            # Importance weights between the current policy and 
+            # whichever one generated the memories
+            with torch.no_grad():
+                new_p = torch.zeros(p.size())
+                for b in batches:
+                    new_p[b] = self._forward(s[b], critic=False)[0].log_prob(a[b])
+
+            advantages, r = vtrace(r, v, t, (new_p - p).exp(), self.gamma, self.lmbda)
+            advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-5)
+        elif self.gae:
+            advantages, r = gae(r, v, t, self.gamma, self.lmbda)
+            advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-5)
+        else:
             # Calculate discounted reward
-            rewards = []
-            discounted_reward = 0
-            for reward, is_terminal in zip(reversed(r), reversed(t)):
-                if is_terminal:
-                    discounted_reward = 0
-                discounted_reward = reward + self.gamma * discounted_reward
-                rewards.insert(0, discounted_reward)
+            r = discount(r, t, self.gamma)
 
             # Normalize 
-            r = torch.tensor(rewards, dtype=torch.float)
             r = (r - r.mean()) / (r.std() + 1e-5) # Normalize rewards
 
             # Calculate advantage 
             advantages = r - torch.tensor(v)
+
+        for e in range(self.epochs):
+            batches = self.memory.get_batches()[-1]
             closs,aloss,eloss = 0,0,0
 
             # Optimize for clipped advantage for each minibatch 
             for b_idx,b in enumerate(batches):
-                b = b.tolist()
-                new_probs = []
-
-                # Combine graphs from minibatches so GNN is called once
-                s_ = [s[idx] for idx in b]
-                a_ = [a[idx] for idx in b]
-                batched_states = combine_marl_states(s_)
+                # Pull graphs for the minibatch out of packed storage 
+                # as one combined graph so GNN is called once
+                batched_states = s[b]
 
                 self._zero_grad()
 
                 # Forward pass 
-                dist = self.actor(*batched_states)
-                critic_vals = self.critic(*batched_states)
+                dist,critic_vals = self._forward(batched_states)
 
-                new_probs = dist.log_prob(torch.tensor(a_))
-                old_probs = torch.tensor([p[i] for i in b])
+                new_probs = dist.log_prob(a[b])
+                old_probs = p[b]
                 entropy = dist.entropy()
 
                 a_t = advantages[b]
@@ -484,6 +660,40 @@ class InductiveGraphPPOAgent():
         return total_loss.item()
 
 
+@torch.no_grad()
+def get_actions(agents, obs):
+    '''
+    Get actions for many agents in as few forward passes as possible.
+    Unblocked states for agents that are the same object (i.e. share 
+    weights) are batched together. Single- and multi-subnet states 
+    can't share a batch, so those are kept apart. 
+
+    Args: 
+        agents: dict of key -> InductiveGraphPPOAgent
+        obs:    dict of key -> (state, is_blocked) 
+
+    Returns dict of key -> output of agent.get_action 
+    (None for blocked agents)
+    '''
+    out = dict()
+    groups = dict()
+    for k,(state,is_blocked) in obs.items():
+        if is_blocked:
+            out[k] = None
+            continue
+
+        agent = agents[k]
+        group = groups.setdefault((id(agent), state[-1]), (agent, [], []))
+        group[1].append(k)
+        group[2].append(state)
+
+    for agent,keys,states in groups.values():
+        for k,o in zip(keys, agent.get_actions(states)):
+            out[k] = o
+
+    return out
+
+
 def load(in_f):
     '''
     Loads model checkpoint file 
@@ -491,6 +701,11 @@ def load(in_f):
     data = torch.load(in_f)
     args,kwargs = data['agent']
 
+    # Older shared trunk checkpoints saved the critic hidden sizes too, 
+    # even though the head never used them
+    if kwargs.get('shared_trunk'):
+        kwargs['c_kwargs'] = {k:v for k,v in kwargs['c_kwargs'].items() if k == 'lr'}
+
     agent = InductiveGraphPPOAgent(*args, **kwargs)
     agent.actor.load_state_dict(data['actor'])
     agent.critic.load_state_dict(data['critic'])
@@ -1,12 +1,148 @@
+import os 
+
+import numpy as np 
 import torch 
 
+class RaggedTensor:
+    '''
+    Variable-length slices for many states packed into one growable 
+    tensor along `dim`. Slice i is data[ptr[i]:ptr[i+1]] (CSR-style)
+    '''
+    def __init__(self, dim=0):
+        self.dim = dim
+        self.data = None
+        self.n = 0
+        self.ptr = [0]
+
+    def __len__(self):
+        return len(self.ptr) - 1
+
+    def append(self, t):
+        k = t.size(self.dim)
+
+        if self.data is None:
+            shape = list(t.shape)
+            shape[self.dim] = max(k, 64)
+            self.data = t.new_empty(shape)
+
+        elif self.n + k > self.data.size(self.dim):
+            shape = list(self.data.shape)
+            shape[self.dim] = max(self.n + k, 2*self.data.size(self.dim))
+            data = self.data.new_empty(shape)
+            data.narrow(self.dim, 0, self.n).copy_(self.view())
+            self.data = data
+
+        self.data.narrow(self.dim, self.n, k).copy_(t)
+        self.n += k
+        self.ptr.append(self.n)
+
+    def view(self):
+        return self.data.narrow(self.dim, 0, self.n)
+
+    def gather(self, idx):
+        '''
+        Concatenate the slices of states idx in one index_select. 
+        Returns the data, and the length of each slice
+        '''
+        ptr = torch.tensor(self.ptr)
+        starts = ptr[idx]
+        lens = ptr[idx+1] - starts
+        offsets = lens.cumsum(0) - lens
+
+        flat = torch.repeat_interleave(starts - offsets, lens) + torch.arange(int(lens.sum()))
+        return self.data.index_select(self.dim, flat), lens
+
+    @staticmethod
+    def cat(rts):
+        out = RaggedTensor(dim=rts[0].dim)
+        rts = [rt for rt in rts if len(rt)]
+        if not rts:
+            return out
+
+        out.data = torch.cat([rt.view() for rt in rts], dim=out.dim)
+
+        for rt in rts:
+            out.ptr += [p + out.n for p in rt.ptr[1:]]
+            out.n += rt.n
+
+        return out
+
+    def __getstate__(self):
+        # Don't pickle unused capacity
+        state = self.__dict__.copy()
+        if self.data is not None:
+            state['data'] = self.view().clone()
+        return state
+
+
+class PackedStates:
+    '''
+    Graph states of the form
+        x, ei, global_vec, servers, n_servers, users, n_users, action_edges, is_multi_subnet
+    stored in contiguous packed tensors (like a torch_geometric Batch) instead
+    of a list of tuples of small tensors. Indexing with a tensor of state ids 
+    gives the same thing as utils.combine_marl_states on those states
+    '''
+    # Fields that hold node ids, and need to be offset when states are combined 
+    NODE_IDS = (1, 3, 5, 7)
+
+    def __init__(self):
+        self.fields = [RaggedTensor(dim=1 if i in (1,7) else 0) for i in range(8)]
+        self.is_multi = []
+
+    def __len__(self):
+        return len(self.is_multi)
+
+    def append(self, state):
+        for f,t in zip(self.fields, state[:-1]):
+            f.append(t)
+        self.is_multi.append(state[-1])
+
+    def __getitem__(self, idx):
+        idx = torch.as_tensor(idx, dtype=torch.long)
+
+        out = []
+        n_nodes = None
+        for i,f in enumerate(self.fields):
+            data, lens = f.gather(idx)
+
+            if i == 0:
+                n_nodes = lens
+                node_offsets = n_nodes.cumsum(0) - n_nodes
+            elif i in self.NODE_IDS:
+                data = data + torch.repeat_interleave(node_offsets, lens)
+
+            # Ids are stored as int32 on disk (see TrajectoryWriter)
+            if data.dtype == torch.int32:
+                data = data.long()
+
+            out.append(data)
+
+        # Is_Multi should be the same for all elements
+        return (*out, self.is_multi[idx[0]])
+
+    @staticmethod
+    def cat(packed):
+        packed = [p for p in packed if len(p)]
+        out = PackedStates()
+        if not packed:
+            return out
+
+        out.fields = [
+            RaggedTensor.cat([p.fields[i] for p in packed])
+            for i in range(len(out.fields))
+        ]
+        out.is_multi = sum([p.is_multi for p in packed], [])
+        return out
+
+
 class PPOMemory:
     '''
     Holds memories for agents that are relevant to the 
     PPO optimization procedure
     '''
     def __init__(self, bs):
-        self.s = []
+        self.s = PackedStates()
         self.a = []
         self.v = []
         self.p = []
@@ -38,7 +174,7 @@ class PPOMemory:
         '''
         Empties the memory buffer 
         '''
-        self.s = []; self.a = []
+        self.s = PackedStates(); self.a = []
         self.v = []; self.p = []
         self.r = []; self.t = []
 
@@ -73,12 +209,13 @@ class MultiPPOMemory:
     def get_batches(self): 
         offset = 0
         idxs = []
-        all_s = []; all_a = []
+        all_a = []
         all_v = []; all_p = []
         all_r = []; all_t = []
 
-        for i in range(self.tot):
-            all_s += self.mems[i].s
+        # During training, mems is replaced with one buffer per episode
+        # so there may be more than self.tot of them
+        for i in range(len(self.mems)):
             all_a += self.mems[i].a
             all_v += self.mems[i].v
             all_p += self.mems[i].p
@@ -87,7 +224,134 @@ class MultiPPOMemory:
             
             cnt = len(self.mems[i].s)
             idx = torch.randperm(cnt) + offset 
-            idxs += list(idx.split(self.bs))
+            if cnt:
+                idxs += list(idx.split(self.bs))
             offset += cnt 
 
-        return all_s, all_a, all_v, all_p, all_r, all_t, idxs
\ No newline at end of file
+        all_s = PackedStates.cat([mem.s for mem in self.mems])
+        return all_s, all_a, all_v, all_p, all_r, all_t, idxs
+
+
+class TrajectoryWriter:
+    '''
+    Saves memory buffers to disk so they can be trained on again later
+    without regenerating episodes. Every call to write() adds one chunk:
+    a directory with one .npy file per column. Ragged state fields are 
+    saved the same way RaggedTensor holds them (flat data + ptr), so 
+    chunks can be memory-mapped and gathered from by TrajectoryDataset 
+    without reading the whole thing into RAM. Node/edge ids are stored 
+    as int32. 
+    '''
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+        # Pick up where an earlier run left off 
+        self.n_chunks = len([d for d in os.listdir(root) if d.startswith('chunk_')])
+
+    def write(self, mems):
+        '''
+        Args: 
+            mems: list of PPOMemory (e.g. one per episode). Written as one chunk
+        '''
+        s = PackedStates.cat([m.s for m in mems])
+        if not len(s):
+            return
+
+        cols = dict()
+        for i,f in enumerate(s.fields):
+            data = f.view()
+            if data.dtype == torch.int64:
+                data = data.int()
+
+            cols[f's{i}'] = data.numpy()
+            cols[f's{i}_ptr'] = np.array(f.ptr, dtype=np.int64)
+
+        cols['is_multi'] = np.array(s.is_multi, dtype=bool)
+        cols['a'] = np.array(sum([m.a for m in mems], []), dtype=np.int64)
+        cols['v'] = np.array(sum([m.v for m in mems], []), dtype=np.float32)
+        cols['p'] = np.array(sum([m.p for m in mems], []), dtype=np.float32)
+        cols['r'] = np.array(sum([m.r for m in mems], []), dtype=np.float32)
+        cols['t'] = np.array(sum([m.t for m in mems], []), dtype=np.int8)
+
+        # Write somewhere else first so readers never see half a chunk
+        path = os.path.join(self.root, f'chunk_{self.n_chunks:06d}')
+        tmp = path + '.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        for k,v in cols.items():
+            np.save(os.path.join(tmp, f'{k}.npy'), v)
+
+        os.rename(tmp, path)
+        self.n_chunks += 1
+
+
+class TrajectoryDataset:
+    '''
+    Reads chunks written by TrajectoryWriter. Columns are memory-mapped,
+    so only the parts of a chunk that get indexed are actually read. 
+    '''
+    def __init__(self, root, bs=2500):
+        self.root = root
+        self.bs = bs
+        self.chunks = sorted(
+            os.path.join(root, d) for d in os.listdir(root)
+            if d.startswith('chunk_') and not d.endswith('.tmp')
+        )
+
+    def __len__(self):
+        return sum(
+            np.load(os.path.join(c, 't.npy'), mmap_mode='r').shape[0]
+            for c in self.chunks
+        )
+
+    def load(self, i):
+        '''
+        Returns chunk i as a PPOMemory whose states are backed by the
+        memory-mapped files. Can be put in agent.memory.mems to rerun PPO
+        '''
+        path = self.chunks[i]
+        col = lambda k : np.load(os.path.join(path, f'{k}.npy'), mmap_mode='c')
+
+        mem = PPOMemory(self.bs)
+        for j,f in enumerate(mem.s.fields):
+            f.data = torch.from_numpy(col(f's{j}'))
+            f.ptr = col(f's{j}_ptr').tolist()
+            f.n = f.ptr[-1]
+
+        mem.s.is_multi = col('is_multi').tolist()
+        mem.a = col('a').tolist()
+        mem.v = col('v').tolist()
+        mem.p = col('p').tolist()
+        mem.r = col('r').tolist()
+        mem.t = col('t').tolist()
+        return mem
+
+    def memories(self):
+        '''
+        Generator over every chunk as a PPOMemory. Only one is loaded at a time
+        '''
+        for i in range(len(self.chunks)):
+            yield self.load(i)
+
+    def batches(self, shuffle=True):
+        '''
+        Stream minibatches of (states, a, v, p, r, t) of up to `self.bs` steps, 
+        where states is already combined into one graph (see PackedStates). 
+        Batches never span chunks, and single/multi subnet states are 
+        never in the same batch. 
+        '''
+        order = torch.randperm(len(self.chunks)) if shuffle else torch.arange(len(self.chunks))
+        for c in order.tolist():
+            mem = self.load(c)
+            is_multi = torch.tensor(mem.s.is_multi, dtype=torch.bool)
+            a,v,p,r,t = [torch.tensor(x) for x in (mem.a, mem.v, mem.p, mem.r, mem.t)]
+
+            for multi in (False, True):
+                idx = is_multi.eq(multi).nonzero().squeeze(-1)
+                if idx.size(0) == 0:
+                    continue
+                if shuffle:
+                    idx = idx[torch.randperm(idx.size(0))]
+
+                for b in idx.split(self.bs):
+                    yield mem.s[b], a[b], v[b], p[b], r[b], t[b]
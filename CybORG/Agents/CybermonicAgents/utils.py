@@ -53,4 +53,101 @@ def combine_marl_states(s):
     edges = torch.cat(new_edges, dim=1)
 
     # Is_Multi should be the same for all elements
-    return xs,eis,gvs, srvs,nsrvs, usrs,nusrs, edges, is_multi[0]
\ No newline at end of file
+    return xs,eis,gvs, srvs,nsrvs, usrs,nusrs, edges, is_multi[0]
+
+def discount(x, done, factor, chunk=256):
+    '''
+    Vectorized version of 
+        y[t] = x[t] + factor * y[t+1] * (1 - done[t])
+    where done[t] marks the last step of an episode. 
+
+    Steps are split into episodes, padded into an (episodes x longest episode)
+    matrix, and discounted `chunk` steps at a time with a matmul against an 
+    upper triangular matrix of factor^(j-t). Only the carry between chunks 
+    is done in a (short) python loop.
+    '''
+    x = torch.as_tensor(x, dtype=torch.float64)
+    done = torch.as_tensor(done, dtype=torch.bool)
+    if x.size(0) == 0:
+        return x.float()
+
+    # Which episode each step is in, and where it is in that episode
+    ep = torch.cat([done.new_zeros(1), done[:-1]]).long().cumsum(0)
+    lens = torch.bincount(ep)
+    starts = lens.cumsum(0) - lens
+    pos = torch.arange(x.size(0)) - starts[ep]
+
+    # Pad episodes so they're a multiple of chunk long
+    chunk = min(chunk, int(lens.max()))
+    n_chunks = -(-int(lens.max()) // chunk)
+    padded = x.new_zeros(lens.size(0), n_chunks*chunk)
+    padded[ep, pos] = x
+    padded = padded.reshape(lens.size(0), n_chunks, chunk)
+
+    # M[j,t] = factor^(j-t) if j >= t
+    k = torch.arange(chunk)
+    d = k.unsqueeze(1) - k.unsqueeze(0)
+    M = torch.where(d >= 0, factor ** d.clamp(min=0).double(), 0.)
+    y = padded @ M
+
+    # Add discounted sum from the start of the next chunk
+    carry = factor ** (chunk - k).double()
+    for c in range(n_chunks-2, -1, -1):
+        y[:, c] += carry * y[:, c+1, :1]
+
+    return y.reshape(lens.size(0), -1)[ep, pos].float()
+
+def gae(r, v, done, gamma, lmbda):
+    '''
+    Generalized advantage estimation. Value after the last step
+    of each episode (or the end of the buffer) is taken to be 0. 
+
+    Returns advantages, and the critic targets (advantages + v)
+    '''
+    r = torch.as_tensor(r, dtype=torch.float)
+    v = torch.as_tensor(v, dtype=torch.float)
+    done = torch.as_tensor(done, dtype=torch.bool)
+
+    v_next = torch.cat([v[1:], v.new_zeros(1)])
+    v_next[done] = 0
+
+    delta = r + gamma*v_next - v
+    advantages = discount(delta, done, gamma*lmbda)
+    return advantages, advantages + v
+
+def vtrace(r, v, done, rho, gamma, lmbda=1., rho_bar=1., c_bar=1.):
+    '''
+    V-trace targets (Espeholt et al., 2018) for memories generated by an 
+    older policy than the one being trained. `rho` is pi(a|s) / mu(a|s) 
+    for each step, where mu is the policy that generated it. With 
+    rho = 1 everywhere, the critic targets are the same as gae's
+
+    Returns advantages, and the critic targets v_s
+    '''
+    r = torch.as_tensor(r, dtype=torch.float)
+    v = torch.as_tensor(v, dtype=torch.float)
+    done = torch.as_tensor(done, dtype=torch.bool)
+    rho = torch.as_tensor(rho, dtype=torch.float)
+
+    v_next = torch.cat([v[1:], v.new_zeros(1)])
+    v_next[done] = 0
+
+    delta = rho.clamp(max=rho_bar) * (r + gamma*v_next - v)
+    c = lmbda * rho.clamp(max=c_bar)
+
+    # v_s - V(s) = delta_s + gamma * c_s * (v_{s+1} - V(s+1))
+    # Factor changes every step so discount() can't be used here 
+    vs_minus_v = [0.] * r.size(0)
+    acc = 0.
+    for i,(d,c_i,t) in enumerate(zip(delta.tolist()[::-1], c.tolist()[::-1], done.tolist()[::-1])):
+        if t:
+            acc = 0.
+        acc = d + gamma * c_i * acc
+        vs_minus_v[-(i+1)] = acc
+
+    vs = torch.tensor(vs_minus_v) + v
+    vs_next = torch.cat([vs[1:], vs.new_zeros(1)])
+    vs_next[done] = 0
+
+    advantages = r + gamma*vs_next - v
+    return advantages, vs
@@ -8,6 +8,7 @@ SUB_TECHNIQUE = "LLM+RL"
 BLUE_AGENT_NAME = "blue_agent_4"
 ALL_LLM_AGENTS = False              # DANGER: Do you want all the LLM agents to play?
 NO_LLM_AGENTS = False                # Do not enable both at the same time!
+CONCURRENT_LLM_INFERENCE = False    # Send all LLM agents' requests at once when observations arrive
 
 # Config files
 CONFIG_MODEL_PATH = "config/model/dummy.yml"
@@ -14,8 +14,9 @@ class DeepSeekBackend(ModelBackend):
             "X-Title": "CAGE Project"
         }
         
-        self.openai_client = OpenAI(base_url="https://openrouter.ai/api/v1", 
-                                    api_key=api_key)
+        self.openai_client = OpenAI(base_url=hyperparams.get("base_url", "https://openrouter.ai/api/v1"), 
+                                    api_key=api_key,
+                                    max_retries=hyperparams.get("max_retries", 2))
         self.model_name = hyperparams.get("model_name", "").lower()
         self.temperature = hyperparams["generate"]["temperature"]
         self.max_tokens = hyperparams["generate"]["max_new_tokens"]
@@ -2,6 +2,7 @@ import torch
 from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
 from typing import List, Dict
 from CybORG.Agents.LLMAgents.llm_adapter.backend.model_backend import ModelBackend
+from CybORG.Agents.LLMAgents.llm_adapter.utils.logger import Logger
 
 import weave
 
@@ -21,27 +22,146 @@ class HuggingFaceBackend(ModelBackend):
         ).to(DEVICE)
         self.tokenizer = AutoTokenizer.from_pretrained(self.hyperparams["model_name"])
 
+        # Decoder-only models need the padding on the left for batched generation
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # Opt-in: the leading system messages (strategy prompt, rules) are the same every
+        # step, so encode them once and reuse their past key values. The first batch that
+        # would use the cache is also run without it, and the cache is turned off if the
+        # greedy outputs differ (see check_prefix_cache)
+        self.prefix_cache = self.hyperparams.get("prefix_cache", False)
+        self._prefix_checked = False
+        self._prefix = None
+        self._prefix_ids = None
+        self._prefix_past = None
+
     @weave.op
     def generate(self, messages: List[Dict[str, str]]) -> str:
-        formatted_prompt = self._format_messages_history(messages)
-        inputs = self.tokenizer(
-            formatted_prompt,
+        return self.generate_batch([messages])[0]
+
+    @weave.op
+    def generate_batch(self, conversations: List[List[Dict[str, str]]]) -> List[str]:
+        """Generates responses for all the conversations with a single model.generate call."""
+        inputs = self._cached_inputs(conversations) if self.prefix_cache else None
+        if inputs is not None and not self._prefix_checked:
+            self._prefix_checked = True
+            if not self.check_prefix_cache(conversations):
+                Logger.warning("Prefix cache output differs from the uncached output, disabling it")
+                self.prefix_cache = False
+                inputs = None
+        if inputs is None:
+            inputs = self._full_inputs(conversations)
+
+        generate_ids = self._generate(inputs)
+        responses = self.tokenizer.batch_decode(generate_ids, skip_special_tokens=True)
+        return [self._format_response(response) for response in responses]
+
+    def check_prefix_cache(self, conversations: List[List[Dict[str, str]]]) -> bool:
+        """Whether greedy decoding gives the same tokens with and without the prefix cache."""
+        inputs = self._cached_inputs(conversations)
+        if inputs is None:
+            return True
+        full_inputs = self._full_inputs(conversations)
+
+        # The prompts are padded differently, so only compare the new tokens
+        cached = self._generate(inputs, do_sample=False)[:, inputs["input_ids"].size(1):]
+        uncached = self._generate(full_inputs, do_sample=False)[:, full_inputs["input_ids"].size(1):]
+        return torch.equal(cached, uncached)
+
+    def _generate(self, inputs: dict, **kwargs):
+        """Runs model.generate with the configured settings (kwargs override them)."""
+        generate_kwargs = dict(
+            max_new_tokens=self.hyperparams["generate"]["max_new_tokens"],
+            do_sample=self.hyperparams["generate"]["do_sample"],
+            top_p=self.hyperparams["generate"]["top_p"],
+            temperature=self.hyperparams["generate"]["temperature"],
+            pad_token_id=self.tokenizer.pad_token_id,
+            eos_token_id=self.tokenizer.eos_token_id
+        )
+        generate_kwargs.update(kwargs)
+        if not generate_kwargs["do_sample"]:
+            generate_kwargs.pop("top_p")
+            generate_kwargs.pop("temperature")
+
+        with torch.no_grad():
+            return self.model.generate(**inputs, **generate_kwargs)
+
+    def _full_inputs(self, conversations: List[List[Dict[str, str]]]):
+        """Tokenize every formatted conversation from the start."""
+        formatted_prompts = [self._format_messages_history(messages) for messages in conversations]
+        return self.tokenizer(
+            formatted_prompts,
             return_tensors="pt",
             padding=True,
             truncation=True,
             max_length=self.hyperparams["generate"]["max_length"],
         ).to(DEVICE)
+
+    def _split_prefix(self, messages: List[Dict[str, str]]):
+        """Split the formatted conversation into its leading system messages and the rest."""
+        n = 0
+        while n < len(messages) - 1 and messages[n]["role"] == "system":
+            n += 1
+        prefix = self._format_messages_history(messages[:n])[:-len("<|assistant|>")]
+        return prefix, self._format_messages_history(messages)[len(prefix):]
+
+    def _get_prefix_past(self, prefix: str):
+        """Encode the prefix, unless it's the same one as last time."""
+        if prefix != self._prefix:
+            ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(DEVICE)
+            with torch.no_grad():
+                past = self.model(ids, use_cache=True).past_key_values
+            if hasattr(past, "to_legacy_cache"):
+                past = past.to_legacy_cache()
+            self._prefix, self._prefix_ids, self._prefix_past = prefix, ids, past
+        return self._prefix_ids, self._prefix_past
+
+    def _cached_inputs(self, conversations: List[List[Dict[str, str]]]):
+        """Build generate() inputs that start from the cached prefix.
         
-        with torch.no_grad():
-            generate_ids = self.model.generate(
-                **inputs,
-                max_new_tokens=self.hyperparams["generate"]["max_new_tokens"],
-                do_sample=self.hyperparams["generate"]["do_sample"],
-                top_p=self.hyperparams["generate"]["top_p"],
-                temperature=self.hyperparams["generate"]["temperature"],
-                pad_token_id=self.tokenizer.pad_token_id,
-                eos_token_id=self.tokenizer.eos_token_id
-            )
-    
-        response = self.tokenizer.batch_decode(generate_ids, skip_special_tokens=True)[0]
-        return self._format_response(response)
\ No newline at end of file
+        Each prompt is tokenized whole (tokens can merge across the prefix/suffix boundary)
+        and split at the prefix token length, so the ids are the same ones the uncached path
+        would feed the model. The suffixes are padded on the left, so any padding sits
+        between the prefix and the suffix and is masked out. Returns None if the
+        conversations don't share a system prefix, the prompt doesn't start with the
+        cached prefix tokens, or it wouldn't fit in max_length, so the caller encodes
+        everything.
+        """
+        splits = [self._split_prefix(messages) for messages in conversations]
+        prefix = splits[0][0]
+        if not prefix or any(p != prefix for p, _ in splits):
+            return None
+
+        prefix_ids, past = self._get_prefix_past(prefix)
+        n = prefix_ids.size(1)
+        prompts = self.tokenizer([prefix + suffix for prefix, suffix in splits]).input_ids
+        if any(len(ids) > self.hyperparams["generate"]["max_length"] for ids in prompts):
+            return None
+        if any(ids[:n] != prefix_ids[0].tolist() for ids in prompts):
+            return None
+
+        suffixes = [ids[n:] for ids in prompts]
+        width = max(len(ids) for ids in suffixes)
+        input_ids = torch.full((len(suffixes), width), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(suffixes), width), dtype=torch.long)
+        for i, ids in enumerate(suffixes):
+            if ids:
+                input_ids[i, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+                attention_mask[i, width - len(ids):] = 1
+
+        # generate() extends the cache in place, so every call gets its own copy
+        batch = len(conversations)
+        past = tuple(
+            tuple(t.expand(batch, *t.shape[1:]).clone() for t in layer)
+            for layer in past
+        )
+        return {
+            "input_ids": torch.cat([prefix_ids.expand(batch, -1), input_ids.to(DEVICE)], dim=1),
+            "attention_mask": torch.cat([
+                torch.ones(batch, n, dtype=torch.long, device=DEVICE),
+                attention_mask.to(DEVICE),
+            ], dim=1),
+            "past_key_values": past,
+        }
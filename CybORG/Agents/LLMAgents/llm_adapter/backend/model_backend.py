@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 
 class ModelBackend(ABC):
@@ -14,6 +15,23 @@ class ModelBackend(ABC):
             str: The generated response.
         """
         pass
+
+    def generate_batch(self, conversations: List[List[Dict[str, str]]]) -> List[str]:
+        """Generates a response for each conversation.
+
+        By default this just runs generate concurrently, which is what HTTP backends want.
+        Local backends should override it to run the whole batch through the model at once.
+
+        Args:
+            conversations (List[List[Dict[str, str]]]): A list of message lists.
+
+        Returns:
+            List[str]: The generated responses, in the same order.
+        """
+        if len(conversations) <= 1:
+            return [self.generate(messages) for messages in conversations]
+        with ThreadPoolExecutor(max_workers=len(conversations)) as executor:
+            return list(executor.map(self.generate, conversations))
     
     def _format_messages_history(self, messages) -> str:
         """Format the conversation history for the LLM."""
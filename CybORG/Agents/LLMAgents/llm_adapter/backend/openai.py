@@ -8,7 +8,11 @@ class OpenAIBackend(ModelBackend):
     """OpenAI model backend."""
 
     def __init__(self, hyperparams: dict, api_key: str):
-        self.openai_client = OpenAI(api_key=api_key) 
+        self.openai_client = OpenAI(
+            api_key=api_key,
+            base_url=hyperparams.get("base_url"),  # None means api.openai.com
+            max_retries=hyperparams.get("max_retries", 2),
+        )
         self.model_name = hyperparams["model_name"].lower()
         self.temperature = hyperparams["generate"]["temperature"]
         self.max_tokens = hyperparams["generate"]["max_new_tokens"]
@@ -30,7 +34,11 @@ class NewOpenAIBackend(ModelBackend):
     """OpenAI model backend for new models"""
 
     def __init__(self, hyperparams: dict, api_key: str):
-        self.openai_client = OpenAI(api_key=api_key) 
+        self.openai_client = OpenAI(
+            api_key=api_key,
+            base_url=hyperparams.get("base_url"),
+            max_retries=hyperparams.get("max_retries", 2),
+        )
         self.model_name = hyperparams["model_name"].lower()
         self.temperature = hyperparams["generate"]["temperature"]
         self.max_tokens = hyperparams["generate"]["max_new_tokens"]
@@ -0,0 +1,216 @@
+"""Local OpenAI-compatible server for testing the LLM agents without a network.
+
+Answers POST /v1/chat/completions after a configurable delay, with a configurable error
+rate, and either replays a scripted list of actions or picks an action from the
+observation in the prompt with a few simple rules. Good enough to load-test the
+concurrency and caching layers end to end.
+
+Use it in-process with the "mock" backend (see config/model/mock.yml), or run it on its
+own and point any OpenAI-style backend at it with base_url:
+
+    python -m CybORG.Agents.LLMAgents.llm_adapter.mock_server --port 8000 --latency lognormal:-0.5,0.5
+"""
+import json
+import random
+import re
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from CybORG.Agents.LLMAgents.llm_adapter.obs_formatter import ALERT_MSG, MAXIMUM_ALERT_MSG, WARNING_MSG
+
+# Seconds to wait before answering, drawn from one of these
+LATENCY_DISTRIBUTIONS = {
+    "constant": lambda rng, value=0.: value,
+    "uniform": lambda rng, low=0., high=1.: rng.uniform(low, high),
+    "normal": lambda rng, mean=0.5, std=0.1: max(0., rng.gauss(mean, std)),
+    "lognormal": lambda rng, mu=-0.5, sigma=0.5: rng.lognormvariate(mu, sigma),
+    "exponential": lambda rng, mean=0.5: rng.expovariate(1 / mean) if mean > 0 else 0.,
+}
+
+
+def policy_action(prompt: str) -> str:
+    """Rule-based stand-in for the LLM: react to the worst alert in the last observation."""
+    observation = prompt.split("# OBSERVATION")[-1]
+
+    host = re.search(re.escape(MAXIMUM_ALERT_MSG) + r" in host (\S+)", observation)
+    if host:
+        return f"Restore host:{host.group(1)}"
+
+    host = re.search(re.escape(ALERT_MSG) + r" in host (\S+)", observation)
+    if host:
+        return f"Remove host:{host.group(1)}"
+
+    for line in observation.splitlines():
+        if WARNING_MSG in line:
+            host = re.search(r"Hostname: ([^\s|]+)", line)
+            if host:
+                return f"Analyse host:{host.group(1)}"
+
+    return "Sleep"
+
+
+class MockOpenAIServer:
+    """OpenAI-compatible chat completions server running in a background thread.
+
+    Args:
+        latency (dict): {"distribution": one of LATENCY_DISTRIBUTIONS, plus its parameters}
+        error_rate (float): Fraction of requests answered with error_status instead.
+        error_status (int): HTTP status of the failed requests (500, 429, ...).
+        responses (list): Actions to reply with, in order (cycled). Uses policy_action if empty.
+        host (str): Interface to bind.
+        port (int): Port to bind, 0 picks a free one.
+        seed (int): Seed for the latency/error draws.
+    """
+    def __init__(self, latency: Optional[dict] = None, error_rate: float = 0., error_status: int = 500,
+                 responses: Optional[List[str]] = None, host: str = "127.0.0.1", port: int = 0,
+                 seed: Optional[int] = None):
+        latency = dict(latency or {"distribution": "constant"})
+        self.latency_fn = LATENCY_DISTRIBUTIONS[latency.pop("distribution")]
+        self.latency_params = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.responses = responses or []
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-openai", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self) -> Dict[str, int]:
+        return {"requests": self.requests, "errors": self.errors}
+
+    def _draw(self):
+        """Pick this request's delay, whether it fails and its scripted response."""
+        with self.lock:
+            i = self.requests
+            self.requests += 1
+            delay = self.latency_fn(self.rng, **self.latency_params)
+            failed = self.rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        scripted = self.responses[i % len(self.responses)] if self.responses else None
+        return delay, failed, scripted
+
+    def _completion(self, request: dict, scripted: Optional[str]) -> dict:
+        messages = request.get("messages", [])
+        prompt = messages[-1]["content"] if messages else ""
+        action = scripted if scripted is not None else policy_action(prompt)
+        content = json.dumps({"action": action, "reason": "mock server"})
+        return {
+            "id": f"chatcmpl-mock-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(content.split()),
+                      "total_tokens": len(prompt.split()) + len(content.split())},
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status: int, body: dict):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/models"):
+                    self._reply(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+                else:
+                    self._reply(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._reply(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+                    return
+
+                delay, failed, scripted = server._draw()
+                time.sleep(delay)
+                if failed:
+                    self._reply(server.error_status, {"error": {"message": "Mock server error", "type": "server_error"}})
+                else:
+                    self._reply(200, server._completion(request, scripted))
+
+            def log_message(self, format, *args):
+                pass  # Way too noisy with 5 agents
+
+        return Handler
+
+
+# One server per config per process, so all the agents share the same endpoint
+_servers = {}
+_servers_lock = threading.Lock()
+
+def start_mock_server(config: dict) -> MockOpenAIServer:
+    """Start (or reuse) an in-process server for this mock_server config."""
+    key = json.dumps(config, sort_keys=True)
+    with _servers_lock:
+        if key not in _servers:
+            _servers[key] = MockOpenAIServer(**config).start()
+        return _servers[key]
+
+
+def parse_latency(spec: str) -> dict:
+    """'lognormal:-0.5,0.5' -> {"distribution": "lognormal", "mu": -0.5, "sigma": 0.5}"""
+    name, _, params = spec.partition(":")
+    fn = LATENCY_DISTRIBUTIONS[name]
+    names = fn.__code__.co_varnames[1:fn.__code__.co_argcount]
+    values = [float(p) for p in params.split(",")] if params else []
+    return {"distribution": name, **dict(zip(names, values))}
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description="Local OpenAI-compatible server for offline LLM agent testing")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--latency", default="constant:0", help=f"name:params, one of {list(LATENCY_DISTRIBUTIONS)}")
+    ap.add_argument("--error-rate", type=float, default=0.)
+    ap.add_argument("--error-status", type=int, default=500)
+    ap.add_argument("--responses", nargs="*", default=None, help="Scripted actions to cycle through instead of the rule-based policy")
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+
+    server = MockOpenAIServer(
+        latency=parse_latency(args.latency), error_rate=args.error_rate, error_status=args.error_status,
+        responses=args.responses, host=args.host, port=args.port, seed=args.seed,
+    )
+    print(f"Mock OpenAI server listening on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(f"Served {server.stats()}")
@@ -1,10 +1,15 @@
 import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from CybORG.Agents.LLMAgents.llm_adapter.backend.deepseek import DeepSeekBackend
 from CybORG.Agents.LLMAgents.llm_adapter.backend.model_backend import ModelBackend
 from CybORG.Agents.LLMAgents.llm_adapter.backend.openai import OpenAIBackend
 from CybORG.Agents.LLMAgents.llm_adapter.backend.openai import NewOpenAIBackend
 from CybORG.Agents.LLMAgents.llm_adapter.backend.huggingface import HuggingFaceBackend
 from CybORG.Agents.LLMAgents.llm_adapter.backend.dummy import DummyBackend
+from CybORG.Agents.LLMAgents.llm_adapter.mock_server import start_mock_server
+from CybORG.Agents.LLMAgents.llm_adapter.utils.logger import Logger
+from CybORG.Agents.LLMAgents.llm_adapter.utils.response_cache import ResponseCache
 
 
 HF_TOKEN = os.environ.get("HF_TOKEN")
@@ -28,6 +33,10 @@ class BackendFactory:
             return DeepSeekBackend(hyperparams=hyperparams, api_key=OPENROUTER_API_KEY)
         elif backend_name == "dummy":
             return DummyBackend()
+        elif backend_name == "mock":
+            # OpenAI backend talking to a local server, see mock_server.py
+            server = start_mock_server(hyperparams.get("mock_server", {}))
+            return OpenAIBackend(hyperparams={**hyperparams, "base_url": server.base_url}, api_key="mock")
         else:
             raise ValueError(f"Invalid backend: {backend_name}")
 
@@ -41,7 +50,62 @@ class ModelManager:
         self.hyperparams = hyperparams
         self.backend_name = hyperparams["backend"].lower()
         self.model_backend = BackendFactory.create_backend(self.backend_name, hyperparams)
+
+        # Requests this manager can have in flight at once (see submit)
+        self.max_concurrency = hyperparams.get("max_concurrency", 5)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        # Opt-in, e.g. response_cache: {size: 4096, path: "cache/responses.db"}
+        self.response_cache = None
+        cache_config = hyperparams.get("response_cache")
+        if cache_config:
+            if hyperparams.get("generate", {}).get("temperature", 0) > 0:
+                Logger.warning("Response cache enabled with temperature > 0, repeated prompts will get the same answer")
+            self.response_cache = ResponseCache(
+                hyperparams,
+                size=cache_config.get("size", 1024),
+                path=cache_config.get("path"),
+            )
     
     def generate_response(self, message: str) -> str:
         """Generates a response using the model backend."""
-        return self.model_backend.generate(message)
\ No newline at end of file
+        if self.response_cache is None:
+            return self.model_backend.generate(message)
+
+        response = self.response_cache.get(message)
+        if response is None:
+            response = self.model_backend.generate(message)
+            self.response_cache.put(message, response)
+        return response
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency, thread_name_prefix="llm"
+                )
+        return self._executor
+
+    def submit(self, messages) -> Future:
+        """Starts generating a response in a background thread. Returns a Future for the response."""
+        return self._get_executor().submit(self.generate_response, messages)
+
+    def generate_responses(self, messages_batch: list) -> list[str]:
+        """Generates responses for several conversations at once, in the same order."""
+        if self.response_cache is None:
+            return self.model_backend.generate_batch(messages_batch)
+
+        # Only send the ones we haven't seen before
+        responses = [self.response_cache.get(messages) for messages in messages_batch]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            generated = self.model_backend.generate_batch([messages_batch[i] for i in missing])
+            for i, response in zip(missing, generated):
+                self.response_cache.put(messages_batch[i], response)
+                responses[i] = response
+        return responses
+
+    def cache_stats(self) -> dict:
+        """Hit/miss counters of the response cache (empty if it's disabled)."""
+        return self.response_cache.stats() if self.response_cache is not None else {}
\ No newline at end of file
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+class ResponseCache:
+    """LRU cache of model responses, keyed on the model config and the conversation.
+
+    Only makes sense with deterministic generation (temperature 0), otherwise repeated
+    observations would always get the same sampled answer. If a path is given, responses
+    are also kept in a sqlite file so later evaluation runs (or other processes) can reuse
+    them. Safe to use from the ModelManager worker threads.
+    """
+    def __init__(self, hyperparams: dict, size: int = 1024, path: Optional[str] = None):
+        # Everything that could change the response, minus the cache settings themselves
+        config = {k: v for k, v in hyperparams.items() if k != "response_cache"}
+        self.config_key = json.dumps(config, sort_keys=True, default=str)
+
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)")
+            self.db.commit()
+
+    def key(self, messages: List[Dict[str, str]]) -> str:
+        payload = json.dumps([self.config_key, messages], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        """Returns the cached response, or None on a miss."""
+        key = self.key(messages)
+        with self.lock:
+            response = self.entries.get(key)
+            if response is None and self.db is not None:
+                row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    response = row[0]
+                    self._remember(key, response)
+
+            if response is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, messages: List[Dict[str, str]], response: str):
+        key = self.key(messages)
+        with self.lock:
+            self._remember(key, response)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?)", (key, response))
+                self.db.commit()
+
+    def _remember(self, key: str, response: str):
+        self.entries[key] = response
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.,
+            "size": len(self.entries),
+        }
@@ -3,10 +3,24 @@ from gym import Space
 from CybORG.Agents import BaseAgent
 from ray.rllib.policy.policy import Policy
 from CybORG.Agents.LLMAgents.obs_wrapper import EMPTY_MESSAGE, EnterpriseObsWrapper
+from CybORG.Agents.LLMAgents.config.config_vars import CONCURRENT_LLM_INFERENCE
 
 def RLLib_shim(env, msg_agents: dict):
     return EnterpriseObsWrapper(env, msg_agents=msg_agents)
 
+def prefetch_actions(agents: dict, observations: dict):
+    """Start the LLM requests for every DefenderAgent that has an observation, all at once.
+    
+    Call this when the wrapper hands out new observations (reset/step). Each agent's
+    get_action then only waits for its own response, so a step takes about as long as the
+    slowest request instead of the sum of all of them.
+    """
+    if not CONCURRENT_LLM_INFERENCE:
+        return
+    for name, agent in agents.items():
+        if isinstance(agent, DefenderAgent) and name in observations:
+            agent.prefetch(observations[name])
+
 class DefenderAgent(BaseAgent):
     def __init__(self, name: str, policy: Policy, obs_space: np.ndarray):
         super().__init__(name)
@@ -19,6 +33,9 @@ class DefenderAgent(BaseAgent):
         self.step += 1
         return self.last_action
 
+    def prefetch(self, observation: np.ndarray):
+        self.policy.prefetch(observation)
+
     def end_episode(self):
         self.step = 0
         self.last_action = None
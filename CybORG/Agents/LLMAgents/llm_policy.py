@@ -47,6 +47,9 @@ class LLMDefenderPolicy(Policy):
         self.commvector_rules_prompt = []
         self.current_episode_messages = []
         self.last_action: str = None
+
+        # (obs, messages, Future) for a request started by prefetch()
+        self._pending = None
         
         self._load_all_prompts()
         
@@ -190,23 +193,49 @@ class LLMDefenderPolicy(Policy):
 
         return response
 
+    def _build_messages(self, obs):
+        """Build the first request of the conversation for this observation."""
+        obs_message = obs_formatter.format_observation(obs, self.last_action, self.name)
+        messages = [self.prompts[0]]
+        if INCLUDE_PROMPT_CAGE4_RULES:
+            messages.append(self.cage4_rules_prompt[0])
+        if INCLUDE_PROMPT_COMMVECTOR_RULES:
+            messages.append(self.commvector_rules_prompt[0])
+        messages.append({"role": "user", "content": obs_message})
+        return messages
+
+    def prefetch(self, obs):
+        """Start generating the response to obs in the background.
+        
+        Lets every LLM agent's request run at the same time instead of one after another.
+        The next compute_single_action call with this same obs object waits on it instead of
+        sending its own request.
+        """
+        if not self.prompts:
+            return
+        messages = self._build_messages(obs)
+        self._pending = (obs, messages, self.model_manager.submit(messages))
+
     def compute_single_action(self, obs=None, prev_action=None, **kwargs):
         """Process a single observation and return corresponding action."""
         #TODO: This is currently sending all the prompts in the config file every episode. 
         Logger.new_episode()
-        obs_message = obs_formatter.format_observation(obs, self.last_action, self.name)
         self.current_episode_messages = []
         response = ""
         
         if self.prompts:
-            self.current_episode_messages.append(self.prompts[0])
-            if INCLUDE_PROMPT_CAGE4_RULES:
-                self.current_episode_messages.append(self.cage4_rules_prompt[0])
-            if INCLUDE_PROMPT_COMMVECTOR_RULES:
-                self.current_episode_messages.append(self.commvector_rules_prompt[0])
-            self.current_episode_messages.append({"role": "user", "content": obs_message})
-            response = self.generate_response(self.current_episode_messages)
+            pending, self._pending = self._pending, None
+            if pending is not None and pending[0] is obs:
+                _, self.current_episode_messages, future = pending
+                response = future.result()
+            else:
+                self.current_episode_messages = self._build_messages(obs)
+                response = self.generate_response(self.current_episode_messages)
+
+        return self._finish_action(response), [], {}
 
+    def _finish_action(self, response):
+        """Run any follow-up prompts on top of the first response, log the conversation and extract the action."""
         # If there are multiple prompts, continue the conversation
         if len(self.prompts) > 1 and not INCLUDE_PROMPT_CAGE4_RULES and not INCLUDE_PROMPT_COMMVECTOR_RULES:
             Logger.info("Continuing conversation with additional prompts")
@@ -233,6 +262,8 @@ class LLMDefenderPolicy(Policy):
                     continue
             Logger.conversation_message(msg["role"], msg["content"])
         Logger.success("Conversation complete")
+        if self.model_manager.response_cache is not None:
+            Logger.debug(f"Response cache: {self.model_manager.cache_stats()}")
         Logger.success(f"Final Assistant response:\n[ASSISTANT] {response}")
 
         try:
@@ -247,7 +278,7 @@ class LLMDefenderPolicy(Policy):
         self.step += 1
         self.progress_bar.update(1)
 
-        return action, [], {}
+        return action
 
     def compute_actions(self, obs_batch, state_batches=None, prev_action_batch=None,
                        prev_reward_batch=None, info_batch=None, episodes=None, **kwargs):
@@ -258,22 +289,19 @@ class LLMDefenderPolicy(Policy):
 
         print(f"\nProcessing batch of {len(obs_batch)} observations")
 
-        for i, obs in enumerate(obs_batch):
-            action, state, info = self.compute_single_action(
-                obs,
-                state_batches[i] if state_batches else None,
-                prev_action_batch[i] if prev_action_batch is not None else None,
-                prev_reward_batch[i] if prev_reward_batch is not None else None,
-                info_batch[i] if info_batch else None
-            )
-            actions.append(action)
-            if state:
-                state_out.append(state)
-            if info:
-                for k, v in info.items():
-                    if k not in info_out:
-                        info_out[k] = []
-                    info_out[k].append(v)
+        # First turn of every conversation goes to the backend in one batch. Note all of
+        # them see the same last_action, unlike calling compute_single_action in a loop
+        if self.prompts:
+            messages_batch = [self._build_messages(obs) for obs in obs_batch]
+            responses = self.model_manager.generate_responses(messages_batch)
+        else:
+            messages_batch = [[] for _ in obs_batch]
+            responses = ["" for _ in obs_batch]
+
+        for messages, response in zip(messages_batch, responses):
+            Logger.new_episode()
+            self.current_episode_messages = messages
+            actions.append(self._finish_action(response))
 
         print(f"Batch processing complete. Actions generated: {len(actions)}")
         return actions, state_out, info_out
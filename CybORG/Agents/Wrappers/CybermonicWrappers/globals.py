@@ -1,3 +1,5 @@
+import numpy as np
+
 N_AGENTS = 5
 ROUTERS = [
     'admin_network_subnet', 
@@ -29,6 +31,15 @@ ACCESSABLE_OFFLINE = {
     'restricted_zone_b_subnet_router': ['operational_zone_b_subnet', 'restricted_zone_b_subnet']
 }
 
+# Precomputed version of the above for GraphWrapper._parse_tabular
+# OFFLINE_ROUTES[i,j] is True if ROUTERS[i] can reach ROUTERS[j] without the internet
+# Note: ACCESSABLE_OFFLINE lists subnets, not routers, so this is all False. 
+# Kept that way to match the LAN-only routing existing checkpoints were trained with
+OFFLINE_ROUTES = np.array([
+    [r in ACCESSABLE_OFFLINE[me] for r in ROUTERS]
+    for me in ROUTERS
+])
+
 MY_SUBNETS = {
     0: ['restricted_zone_a_subnet'],
     1: ['operational_zone_a_subnet'],
@@ -37,6 +48,13 @@ MY_SUBNETS = {
     4: ['admin_network_subnet', 'office_network_subnet', 'public_access_zone_subnet']
 }
 
+# Agents 2/3 defend zone B, which is what zone A is to agents 0/1. 
+# Reorders their phase (active zone A <-> B) and the messages from 
+# the other three subnet agents so symmetric agents can share a network
+MIRRORED_AGENTS = (2,3)
+MIRROR_PHASE = [0,2,1]
+MIRROR_MSG = [2,0,1,3,4,5]
+
 MAX_SERVERS = 6
 MAX_USERS = 10 
 MAX_HOSTS = 16
@@ -1,5 +1,3 @@
-from copy import deepcopy
-
 import numpy as np
 import torch
 
@@ -11,16 +9,64 @@ from CybORG.Shared.Enums import TernaryEnum
 from CybORG.Agents.Wrappers.CybermonicWrappers.observation_graph import ObservationGraph
 from CybORG.Agents.Wrappers.CybermonicWrappers.globals import *
 
+class LazyObs:
+    '''
+    Stands in for the tuple from GraphWrapper._to_obs, but only builds it
+    the first time something reads from it. The graph keeps changing as 
+    the env is stepped, so it has to be read before the next call to 
+    step/reset. Pickles as a plain tuple. 
+    '''
+    def __init__(self, build, is_current):
+        self._build = build
+        self._is_current = is_current
+        self._obs = None
+
+    def get(self):
+        if self._obs is None:
+            if not self._is_current():
+                raise RuntimeError('Observation was read after the env it came from was stepped again')
+
+            self._obs = self._build()
+            self._build = self._is_current = None
+
+        return self._obs
+
+    def __getitem__(self, i):
+        return self.get()[i]
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __len__(self):
+        return len(self.get())
+
+    def __reduce__(self):
+        return (tuple, (self.get(),))
+
+
 class GraphWrapper(EnterpriseMAE):
-    def __init__(self, env: CybORG, *args, **kwargs):
+    def __init__(self, env: CybORG, *args, dedup_edges=False, max_ephemeral_age=None,
+                 mirror_symmetric=False, **kwargs):
         super().__init__(env, *args, **kwargs)
 
+        # Passed on to ObservationGraph (see there for details)
+        self.dedup_edges = dedup_edges
+        self.max_ephemeral_age = max_ephemeral_age
+
+        # Swap zone A/B in agent 2/3's observations so they look like 
+        # agent 0/1's (needed if they share weights)
+        self.mirror_symmetric = mirror_symmetric
+
         self.graphs = dict()
+        self.tab_index = dict()
         self.env = env
         self.agent_names = [f'blue_agent_{i}' for i in range(0, 5)]
         # print("agent Names:" +str(self.agent_names))
         self.ts = 0
 
+        # Counts calls to step/reset so LazyObs knows when it's out of date
+        self._step_id = 0
+
         self.msg = {
             a:np.zeros(8)
             for a in self.agent_names
@@ -85,6 +131,7 @@ class GraphWrapper(EnterpriseMAE):
         )
 
         # Tell ObservationGraph what happened and update
+        self._step_id += 1
         graph_obs = dict()
         for i in range(0, 5):
             agent = f'blue_agent_{i}'
@@ -112,6 +159,8 @@ class GraphWrapper(EnterpriseMAE):
                 msg = msg[:, :2]
 
             msg = np.concatenate([msg, recieved_msg], axis=1)
+            if self.mirror_symmetric and i in MIRRORED_AGENTS:
+                msg = msg[MIRROR_MSG]
 
             # Update the graph based on the raw dictionary 
             g.parse_observation(dict_obs)
@@ -119,20 +168,18 @@ class GraphWrapper(EnterpriseMAE):
             # Pull node features from tabular observation, and also update 
             # graph subnet connectivity edges. 
             tab_x,phase,new_msg = self._parse_tabular(o, g) 
+            if self.mirror_symmetric and i in MIRRORED_AGENTS:
+                phase = phase[:, MIRROR_PHASE]
             
             self.msg[agent] = new_msg
 
-            # Combine node features from graph source, and tabular source
-            x,ei,masks = g.get_state(MY_SUBNETS[i])
-            x = self._combine_data(x, tab_x)
-
-            # Mask/pack into conviniently sized tensors for the GNN models 
-            obs = self._to_obs(x,ei,masks,phase,msg,new_msg)
-
-            # During training, we need to know if the agent is still mid-action
-            # If so, we don't bother calculating an action next turn 
+            # If the agent is still mid-action, we don't bother calculating 
+            # an action next turn, so don't bother building its observation
             is_blocked = dict_obs['success'] == TernaryEnum.IN_PROGRESS
-            graph_obs[agent] = (obs, is_blocked)
+            if is_blocked:
+                graph_obs[agent] = (None, is_blocked)
+            else:
+                graph_obs[agent] = (self._lazy_obs(i, g, tab_x, phase, msg, new_msg), is_blocked)
 
         self.ts += 1
         self.last_obs = graph_obs
@@ -143,9 +190,13 @@ class GraphWrapper(EnterpriseMAE):
         Rebuild internal graph representation with parameters of new environment
         '''
         self.ts = 0
+        self._step_id += 1
 
         obs_tab, action_mask = super().reset()
-        g = ObservationGraph()
+        g = ObservationGraph(
+            dedup_edges=self.dedup_edges,
+            max_ephemeral_age=self.max_ephemeral_age
+        )
 
         # I don't *think* this is cheating, because FixedActionWrapper gets
         # to manipulate the obs returned by env.reset() which is the same thing.
@@ -153,6 +204,7 @@ class GraphWrapper(EnterpriseMAE):
         # known only to the agents.
         obs_dict = self.env.environment_controller.init_state
         g.setup(obs_dict)
+        self.tab_index = dict()
 
         # Set message to empty for all agents
         self.msg = {
@@ -172,18 +224,20 @@ class GraphWrapper(EnterpriseMAE):
             else:
                 dummy_msg = (np.zeros((4,3)), np.zeros(8))
 
-            # Duplicate shared observation of the initial graph across
-            # all agents (but make sure not to pass by reference)
-            g_ = deepcopy(g)
+            # Share the initial graph across all agents. Topology and node
+            # features are shared by reference, but each agent gets its 
+            # own copy of the edges it observes
+            g_ = g.fork()
             self.graphs[agent] = g_
 
             # Get tabular features and update connectivity graph 
             tab_x,phase,_ = self._parse_tabular(o,g_)
+            if self.mirror_symmetric and i in MIRRORED_AGENTS:
+                phase = phase[:, MIRROR_PHASE]
 
             # Combine all node features together and package for agents
-            x,ei,masks = g_.get_state(MY_SUBNETS[int(agent[-1])])
-            x = self._combine_data(x, tab_x)
-            obs = self._to_obs(x,ei,masks,phase, *dummy_msg)
+            # (once something asks for them)
+            obs = self._lazy_obs(i, g_, tab_x, phase, *dummy_msg)
 
             # By default, agents are not blocked on turn 0
             my_state[agent] = (obs, False)
@@ -192,6 +246,19 @@ class GraphWrapper(EnterpriseMAE):
         return my_state, action_mask
 
 
+    def _lazy_obs(self, i, g, tab_x, phase, other_msg, my_msg):
+        '''
+        Observation for agent i that's only built (get_state, _combine_data,
+        _to_obs) if an agent actually reads it before the next step
+        '''
+        step_id = self._step_id
+        def build():
+            x,ei,masks = g.get_state(MY_SUBNETS[i])
+            x = self._combine_data(x, tab_x)
+            return self._to_obs(x,ei,masks,phase,other_msg,my_msg)
+
+        return LazyObs(build, lambda : self._step_id == step_id)
+
     def _parse_tabular(self, x, g):
         '''
         Pull the per-host data out of the tabular observation. 
@@ -215,73 +282,69 @@ class GraphWrapper(EnterpriseMAE):
         phase_idx = int(x[0])
         sn_block = x[1:-(4*8)]
         subnets = sn_block.shape[0] // SN_BLOCK_SIZE
+        blocks = sn_block[:subnets*SN_BLOCK_SIZE].reshape(subnets, SN_BLOCK_SIZE)
 
-        relevant_subnets = []
-        src = []
-        dst = []
-        x = torch.zeros(g.n_permenant_nodes, 2)
-        msgs = []
+        # Pull out edges between subnets
+        # (Only affects agent4 but may as well be generalizeable)
+        me = (blocks[:, :9] != 0).argmax(axis=1)
+        can_maybe_connect_to = blocks[:, 9:18] == 0
 
-        # Only affects agent4 but may as well be generalizeable
-        for i in range(subnets):
-            block = sn_block[SN_BLOCK_SIZE*i : SN_BLOCK_SIZE*(i+1)]
+        # Logic for subnet routing. Anything allowed if the internet is 
+        # reachable, otherwise only what's in the LAN
+        online = can_maybe_connect_to[:, INTERNET:INTERNET+1]
+        can_connect_to = can_maybe_connect_to & (online | OFFLINE_ROUTES[me])
 
-            # Pull out edges between subnets
-            sn = block[:18]
-            me = ROUTERS[ sn[:9].nonzero()[0][0] ]
-            can_maybe_connect_to = (sn[9:18] == 0).nonzero()[0]
+        blk, other = can_connect_to.nonzero()
+        src = [ROUTERS[o] for o in other]
+        dst = [ROUTERS[me[b]] for b in blk]
 
-            # Logic for subnet routing 
-            if INTERNET in can_maybe_connect_to:
-                can_connect_to = [ROUTERS[i] for i in can_maybe_connect_to]
-            else:
-                # Can connect to anything in LAN
-                can_connect_to = [
-                    ROUTERS[i] for i in can_maybe_connect_to
-                    if ROUTERS[i] in ACCESSABLE_OFFLINE[me]
-                ]
-
-            router_name = me
-            me = [me] * len(can_connect_to)
-            src += can_connect_to
-            dst += me
-
-            # Pull out features for servers/hosts that exist
-            hosts = torch.from_numpy(block[27:]).reshape(2,16).T
-            n_srv, n_usr = g.subnet_size[router_name]
-            srv_idx = list(range(n_srv))
-            usr_idx = list(range(6,n_usr+6))
-
-            # Insert into rows corresponding w server/host nodes in graph
-            # (Always directly after node for subnet they are on)
-            start_usr_idx = g.nids[router_name]+1
-            start_srv_idx = start_usr_idx + len(usr_idx)
-            end_srv_idx = start_srv_idx + len(srv_idx)
-
-            # Note: TabularWrapper goes from server to host, but
-            # graph goes from host to server (alphabetically)
-            # so we have to do some lifting to rearrange
-            x[start_usr_idx : start_srv_idx] = hosts[usr_idx]
-            x[start_srv_idx : end_srv_idx] = hosts[srv_idx]
-
-            # Each subnet can add 2 bits to the message for if any hosts
-            # are compromised/have been scanned
-            msg = list((hosts.sum(dim=0) > 0).long())
-            msgs += msg
-
-            relevant_subnets.append(router_name)
+        # Pull out features for servers/hosts that exist
+        hosts = blocks[:, 27:].reshape(subnets, 2, 16).transpose(0, 2, 1)   # S x 16 x 2
+
+        # Insert into rows corresponding w server/host nodes in graph
+        # (Always directly after node for subnet they are on)
+        # Note: TabularWrapper goes from server to host, but
+        # graph goes from host to server (alphabetically)
+        # so the precomputed index does the rearranging
+        rows, cols = zip(*[self._tabular_index(g, m) for m in me])
+        blk = np.repeat(np.arange(subnets), [len(r) for r in rows])
+
+        x = np.zeros((g.n_permenant_nodes, 2), dtype=np.float32)
+        x[np.concatenate(rows)] = hosts[blk, np.concatenate(cols)]
+
+        # Each subnet can add 2 bits to the message for if any hosts
+        # are compromised/have been scanned
+        msgs = (hosts.sum(axis=1) > 0).reshape(-1).astype(np.int64)
 
         g.set_firewall_rules(src,dst)
         phase = torch.zeros((1,3))
         phase[0,phase_idx] = 1
 
         # Make messages all 8-dim and add checkbit to the end
-        padding = 8-len(msgs)
-        msgs += [0]*padding
-        msgs[-1] = 1
-        msg = np.array(msgs)
+        msg = np.zeros(8, dtype=np.int64)
+        msg[:msgs.shape[0]] = msgs[:8]
+        msg[-1] = 1
+
+        return torch.from_numpy(x),phase,msg
+
+    def _tabular_index(self, g, router_idx):
+        '''
+        Which rows of the feature matrix the hosts in a subnet's tabular
+        block go to, and which positions in the block they come from. 
+        Only depends on the topology, so computed once per reset
+        '''
+        if (idx := self.tab_index.get(router_idx)) is not None:
+            return idx
+
+        router_name = ROUTERS[router_idx]
+        n_srv, n_usr = g.subnet_size[router_name]
+        start_usr_idx = g.nids[router_name]+1
+
+        rows = np.arange(start_usr_idx, start_usr_idx + n_usr + n_srv)
+        cols = np.concatenate([np.arange(6, n_usr+6), np.arange(n_srv)])
 
-        return x,phase,msg
+        self.tab_index[router_idx] = (rows, cols)
+        return rows, cols
 
     def _combine_data(self, graph_x, tabular_x):
         '''
@@ -54,15 +54,26 @@ class Node(ABC, object):
             if k in obs:
                 self.feats[k] = obs[k]
 
+        # Features changed, so cached vector is stale
+        self._features = None
+
     def get_features(self) -> np.array:
         '''
-        Convert from all the enums to a fixed size vector
+        Convert from all the enums to a fixed size vector.
+        This is cached until the next call to parse_observation, 
+        so don't write into the returned array
 
         Requires the following fields to be initialized:
             self.dim: The output dimension of the feature vector
             self.dims: The output dimensions of individual one-hot features (sum(dims) == dim)
             self.feats: An ordered dict of the features we want
         '''
+        if self._features is None:
+            self._features = self._encode()
+
+        return self._features
+
+    def _encode(self) -> np.array:
         out = np.zeros(self.dim)
 
         offset = 0
@@ -93,6 +104,22 @@ class Node(ABC, object):
 
         return human_readable
 
+def encode_nodes(nodes, offsets, out):
+    '''
+    Write the features of many nodes into the rows of one 
+    preallocated matrix in a single pass 
+
+    Args: 
+        nodes: list of Node objects
+        offsets: column each node's features start at (list of ints)
+        out: len(nodes) x d array to write into
+    '''
+    for i,(node,offset) in enumerate(zip(nodes, offsets)):
+        if node.dim:
+            out[i, offset : offset + node.dim] = node.get_features()
+
+    return out
+
 class SystemNode(Node):
     '''
     Node representing computers (servers, users, and routers)
@@ -1,22 +1,29 @@
 from collections import defaultdict
+from copy import copy
 
 from pprint import pprint
+import numpy as np
 import torch
 
 from CybORG.Simulator.Actions.AbstractActions import Remove, Restore, Analyse, Monitor
 from CybORG.Simulator.Actions.ConcreteActions.DecoyActions import *
 from CybORG.Shared.Enums import TernaryEnum
 
-from CybORG.Agents.Wrappers.CybermonicWrappers.nodes import SystemNode, ConnectionNode, InternetNode, FileNode, init_decoy
+from CybORG.Agents.Wrappers.CybermonicWrappers.nodes import SystemNode, ConnectionNode, InternetNode, FileNode, init_decoy, encode_nodes
 
 class NodeTracker:
     '''
-    Just a hash map with extra steps
+    Just a hash map with extra steps.
+    Ids are handed out in order, so the inverse mapping is just a list
+    indexed by nid. Also keeps track of which nodes belong to which host
+    (anything named host:port or host:file) so we never have to scan
+    every name to find them
     '''
     def __init__(self):
         self.nid = 0
         self.mapping = dict()
-        self.inv_mapping = dict()
+        self.inv_mapping = []
+        self.host_children = defaultdict(list)
 
     def __getitem__(self, node_str):
         node_str = str(node_str)
@@ -25,26 +32,227 @@ class NodeTracker:
 
         # Add to dict if it doesn't exist
         self.mapping[node_str] = self.nid
-        self.inv_mapping[self.nid] = node_str
+        self.inv_mapping.append(node_str)
+
+        # Ports/files are named {hostname}:{whatever}
+        if ':' in node_str:
+            self.host_children[node_str.split(':', 1)[0]].append(self.nid)
 
         self.nid += 1
         return self.mapping[node_str]
 
     def pop(self, node_str):
-        nid = self.mapping.get(node_str, None)
-        if nid:
-            self.mapping.pop(node_str)
-            self.inv_mapping.pop(nid)
+        nid = self.mapping.pop(node_str, None)
+        if nid is not None:
+            self.inv_mapping[nid] = None
+
+            if ':' in node_str:
+                self.host_children[node_str.split(':', 1)[0]].remove(nid)
 
     def get(self, node_str):
         return self.mapping.get(node_str, None)
 
     def id_to_str(self, nid):
-        return self.inv_mapping.get(nid)
+        if 0 <= nid < len(self.inv_mapping):
+            return self.inv_mapping[nid]
+        return None
+
+    def children(self, hostname):
+        '''
+        Nids of all ports/files that have been seen on hostname
+        '''
+        return self.host_children.get(hostname, [])
 
     def names(self):
         return list(self.mapping.keys())
 
+class EdgeStore:
+    '''
+    Preallocated 2 x capacity edge index that is edited in place.
+    Saves us from rebuilding python lists and converting them
+    into tensors every time the state is requested
+
+    If dedup is set, edges that are already in the store are 
+    not added again (otherwise every repeated observation of the 
+    same connection adds another copy of the edge)
+
+    Also counts how many edges touch each node, so ObservationGraph
+    knows which nodes are in the graph without calling unique() on
+    every edge, and keeps a renumbered copy of the edges for
+    ObservationGraph.get_state that only new edges need adding to
+    '''
+    def __init__(self, capacity=256, dedup=False):
+        self.edges = torch.empty((2, capacity), dtype=torch.long)
+        self.n = 0
+
+        self.dedup = dedup
+        self.seen = set()
+        self.n_skipped = 0
+
+        # Edge endpoints per nid. node_version changes whenever a node
+        # gains its first edge or loses its last one
+        self.deg = torch.zeros(capacity, dtype=torch.long)
+        self.node_version = 0
+
+        # edges[:, :compact_n] renumbered with the last remap given to compacted()
+        self.compact = torch.empty((2, capacity), dtype=torch.long)
+        self.compact_n = 0
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self, min_cap):
+        cap = max(self.edges.size(1), 1)
+        while cap < min_cap:
+            cap *= 2
+
+        edges = torch.empty((2, cap), dtype=torch.long)
+        edges[:, :self.n] = self.edges[:, :self.n]
+        self.edges = edges
+
+        compact = torch.empty((2, cap), dtype=torch.long)
+        compact[:, :self.compact_n] = self.compact[:, :self.compact_n]
+        self.compact = compact
+
+    def _count(self, nids, sign):
+        '''
+        Add sign to the degree of every nid (repeats count more than once)
+        '''
+        if nids.numel() == 0:
+            return
+
+        top = int(nids.max()) + 1
+        if top > self.deg.size(0):
+            deg = torch.zeros(max(top, 2*self.deg.size(0)), dtype=torch.long)
+            deg[:self.deg.size(0)] = self.deg
+            self.deg = deg
+
+        touched = nids.unique()
+        before = self.deg[touched] > 0
+        self.deg.index_add_(0, nids, torch.full_like(nids, sign))
+        if not torch.equal(before, self.deg[touched] > 0):
+            self.node_version += 1
+
+    def append(self, src, dst):
+        '''
+        Add edges src[i] -> dst[i]
+        '''
+        if self.dedup:
+            src,dst = self._new_edges(src, dst)
+
+        k = len(src)
+        if k == 0:
+            return
+
+        if self.n + k > self.edges.size(1):
+            self._grow(self.n + k)
+
+        self.edges[0, self.n : self.n+k] = torch.as_tensor(src, dtype=torch.long)
+        self.edges[1, self.n : self.n+k] = torch.as_tensor(dst, dtype=torch.long)
+        self._count(self.edges[:, self.n : self.n+k].flatten(), 1)
+        self.n += k
+
+    def remove_nodes(self, nids):
+        '''
+        Drop any edge with src or dst in nids, and compact what's left
+        '''
+        if self.n == 0 or len(nids) == 0:
+            return
+
+        nids = torch.as_tensor(nids, dtype=torch.long)
+        ei = self.edges[:, :self.n]
+        keep = ~(torch.isin(ei[0], nids) | torch.isin(ei[1], nids))
+        if keep.all():
+            return
+
+        self._count(ei[:, ~keep].flatten(), -1)
+        kept = ei[:, keep]
+        self.n = kept.size(1)
+        self.edges[:, :self.n] = kept
+
+        # Edges moved, so renumber them all next time
+        self.compact_n = 0
+
+        if self.dedup:
+            self.seen = set(zip(*kept.tolist()))
+
+    def _new_edges(self, src, dst):
+        '''
+        Filter out edges that are already stored (or repeated in src,dst)
+        '''
+        new_src, new_dst = [],[]
+        for e in zip(src, dst):
+            if e in self.seen:
+                self.n_skipped += 1
+                continue
+
+            self.seen.add(e)
+            new_src.append(e[0])
+            new_dst.append(e[1])
+
+        return new_src, new_dst
+
+    def view(self):
+        return self.edges[:, :self.n]
+
+    def compacted(self, remap, valid=True):
+        '''
+        Edges with every nid replaced by remap[nid]. Only edges added since
+        the last call get renumbered, unless valid is False (remap changed
+        for nodes that were already here)
+        '''
+        if not valid:
+            self.compact_n = 0
+
+        if self.compact_n < self.n:
+            self.compact[:, self.compact_n:self.n] = remap[self.edges[:, self.compact_n:self.n]]
+            self.compact_n = self.n
+
+        return self.compact[:, :self.n]
+
+    def copy(self):
+        es = EdgeStore(capacity=self.edges.size(1), dedup=self.dedup)
+        es.edges[:, :self.n] = self.edges[:, :self.n]
+        es.n = self.n
+        es.seen = set(self.seen)
+        es.n_skipped = self.n_skipped
+        es.deg = self.deg.clone()
+        es.node_version = self.node_version
+        es.compact[:, :self.compact_n] = self.compact[:, :self.compact_n]
+        es.compact_n = self.compact_n
+        return es
+
+class FeatureStore:
+    '''
+    Feature matrix with one row per nid. Kept in its own object so
+    that forks of an ObservationGraph can share it, and rows only 
+    need to be encoded once no matter how many agents look at them
+    '''
+    def __init__(self, dim, capacity=256):
+        self.x = torch.zeros(capacity, dim)
+        self.dirty = set()
+
+    def reserve(self, n):
+        '''
+        Make sure there are at least n rows
+        '''
+        if n <= self.x.size(0):
+            return
+
+        cap = self.x.size(0)
+        while cap < n:
+            cap *= 2
+
+        x = torch.zeros(cap, self.x.size(1))
+        x[:self.x.size(0)] = self.x
+        self.x = x
+
+    def copy(self):
+        fs = FeatureStore(self.x.size(1), capacity=self.x.size(0))
+        fs.x = self.x.clone()
+        fs.dirty = set(self.dirty)
+        return fs
+
 class ObservationGraph:
     '''
     The main datastructure powering KEEP. 
@@ -82,20 +290,42 @@ class ObservationGraph:
     }
     DECOYS = DECOY_TO_PORT.keys()
 
-    def __init__(self):
+    def __init__(self, dedup_edges=False, max_ephemeral_age=None):
+        '''
+        Args: 
+            dedup_edges: only keep one copy of each transient edge, rather
+                         than one per time the connection was observed
+            max_ephemeral_age: if set, drop edges to ephemeral ports (>49152)
+                         that haven't been observed in this many steps
+        '''
         self.nids = NodeTracker()
         self.nodes = dict()
         self.subnet_to_router = dict()
 
+        # Feature rows for every node, indexed by nid. Rows are only
+        # (re)encoded when a node is added or replaced
+        self.feats = FeatureStore(self.DIM)
+
+        # Nodes (and their feature rows) that a fork added or replaced
+        # itself. None until forked, so setup writes to the shared ones
+        self.own_nodes = None
+        self.own_feats = None
+        self._own_ids = torch.zeros(0, dtype=torch.long)
+
         # Unchanging network topology
-        self.permenant_edges = [[],[]]
+        self.permenant_edges = torch.empty((2,0), dtype=torch.long)
         self.n_permenant_nodes = 0
 
         # Keep track of new connections to ports
-        self.transient_edges = [[],[]]
+        self.transient_edges = EdgeStore(dedup=dedup_edges)
+
+        # Keep track of when ephemeral ports were last seen so they can age out
+        self.max_ephemeral_age = max_ephemeral_age
+        self.ephemeral_seen = dict()
+        self.ts = 0
 
         # Keep track of firewall rules
-        self.subnet_connectivity = [[], []]
+        self.subnet_connectivity = torch.empty((2,0), dtype=torch.long)
 
         # Keep track of which nodes are getting deleted when Remove is called
         self.host_to_sussy = defaultdict(list)
@@ -107,6 +337,12 @@ class ObservationGraph:
         # Keep track of which nodes are in which subnets
         self.subnet_masks = dict()
 
+        # Which nodes are in the state (see _node_index)
+        self.static_nodes = torch.zeros(0, dtype=torch.bool)
+        self._conn_extra = ()
+        self._index_key = None
+        self._index = None
+
     def setup(self, initial_observation: dict):
         '''
         Needs to be called before ObservationGraph object can be used.
@@ -132,10 +368,10 @@ class ObservationGraph:
 
         # Graph of subnets and default open ports doesn't change
         # but connections that we see in observations do. They're transient
-        self.permenant_edges = [
+        self.permenant_edges = torch.tensor([
             list(src) + list(dst),
             list(dst) + list(src)
-        ]
+        ])
         self.n_permenant_nodes = max(max(src), max(dst))+1
 
         # Set up masks so we can quickly get nodes relevant to each agent
@@ -144,6 +380,49 @@ class ObservationGraph:
         # Gotta put it back in case other methods need the observation
         initial_observation['success'] = succ
 
+    def fork(self):
+        '''
+        Cheap per-agent copy of this graph. Node ids, the nodes from setup
+        and their feature rows, and the permenant topology are shared by 
+        reference with this graph (and every other fork). Only what each 
+        agent observes for itself is copied: transient edges, firewall 
+        rules, and which processes are suspicious. 
+
+        Nodes are copy-on-write. Anything a fork adds or replaces (e.g. 
+        deploying a decoy on a port) goes in its own_nodes/own_feats, so 
+        other forks never see it. 
+        '''
+        g = copy(self)
+        if self.own_nodes is None:
+            g.own_nodes = dict()
+            g.own_feats = FeatureStore(self.DIM)
+        else:
+            g.own_nodes = dict(self.own_nodes)
+            g.own_feats = self.own_feats.copy()
+        g.transient_edges = self.transient_edges.copy()
+        g.host_to_sussy = defaultdict(
+            list, {k:list(v) for k,v in self.host_to_sussy.items()}
+        )
+        g.ephemeral_seen = dict(self.ephemeral_seen)
+
+        # The node index goes with the edge store it was built from
+        g._index_key = None
+        return g
+
+    def stats(self):
+        '''
+        How big the (per-agent) graph has gotten 
+        '''
+        te = self.transient_edges.view()
+        return dict(
+            nodes=len(self.nodes.keys() | (self.own_nodes or dict()).keys()),
+            permenant_edges=self.permenant_edges.size(1),
+            transient_edges=te.size(1),
+            transient_nodes=te.unique().size(0),
+            ephemeral_nodes=len(self.ephemeral_seen),
+            duplicate_edges_skipped=self.transient_edges.n_skipped
+        )
+
     def set_firewall_rules(self, src, dst):
         '''
         Add edges between all nodes from src to dst 
@@ -153,7 +432,80 @@ class ObservationGraph:
         src = [self.nids[s] for s in src]
         dst = [self.nids[d] for d in dst]
 
-        self.subnet_connectivity = [src,dst]
+        self.subnet_connectivity = torch.tensor([src,dst], dtype=torch.long)
+
+        # Routers are always in the state already, so this only changes
+        # which nodes are in it if it's given something else
+        conn = self.subnet_connectivity.flatten().unique()
+        known = conn < self.static_nodes.size(0)
+        static = torch.zeros_like(known)
+        static[known] = self.static_nodes[conn[known]]
+        self._conn_extra = tuple(conn[~static].tolist())
+
+    def _set_node(self, nid, node):
+        '''
+        Add or replace a node, and flag its feature row to be re-encoded.
+        Forks only write to their own copy (see fork)
+        '''
+        if self.own_nodes is None:
+            self.nodes[nid] = node
+            self.feats.dirty.add(nid)
+        else:
+            self.own_nodes[nid] = node
+            self.own_feats.dirty.add(nid)
+
+    def _get_node(self, nid):
+        if self.own_nodes is not None and nid in self.own_nodes:
+            return self.own_nodes[nid]
+        return self.nodes.get(nid)
+
+    def _update_features(self):
+        '''
+        Encode feature rows for any nodes that changed since the last call
+        '''
+        self._encode(self.feats, self.nodes)
+
+        if self.own_nodes is not None:
+            self._encode(self.own_feats, self.own_nodes)
+            if len(self.own_nodes) != self._own_ids.size(0):
+                self._own_ids = torch.tensor(sorted(self.own_nodes), dtype=torch.long)
+
+    def _encode(self, feats, nodes):
+        '''
+        Encode the dirty rows of feats from nodes
+        '''
+        # Make sure there's a row for every nid we've handed out
+        feats.reserve(self.nids.nid)
+
+        # Nids that never had a node assigned just keep their zero row
+        nids = [n for n in feats.dirty if n in nodes]
+        feats.dirty.clear()
+        if not nids:
+            return
+
+        nodes = [nodes[n] for n in nids]
+        ntypes = [self.NTYPES[type(n)] for n in nodes]
+        rtr_map = {r:i for i,r in enumerate(self.routers)}
+        rows = np.zeros((len(nids), self.DIM), dtype=np.float32)
+        idx = np.arange(len(nids))
+
+        # One-hot ntype feature
+        rows[idx, ntypes] = 1.
+
+        # Label which subnet it's in (last 9 dims)
+        rows[idx, [self.DIM - 9 + rtr_map[self._subnet_router(n)] for n in nids]] = 1.
+
+        # Multi-dim features (if node has features)
+        encode_nodes(nodes, [self.OFFSETS[t] for t in ntypes], rows)
+
+        feats.x[nids] = torch.from_numpy(rows)
+
+    def _subnet_router(self, nid):
+        '''
+        Nid of the router for the subnet this node is in
+        '''
+        name = self.nids.id_to_str(nid)
+        return self.nids[name[:name.index('subnet') + 6] + '_router']
 
     def _init_node_masks(self):
         '''
@@ -202,27 +554,68 @@ class ObservationGraph:
                         agent_controlled.append(n)
 
             self.subnet_masks[sn] = (
-                srv,
-                usr,
-                [[me] * len(rtr), rtr],
-                agent_controlled
+                torch.tensor(srv, dtype=torch.long),
+                torch.tensor(usr, dtype=torch.long),
+                torch.tensor([[me] * len(rtr), rtr], dtype=torch.long),
+                torch.tensor(agent_controlled, dtype=torch.long)
             )
+
+        # Routers get self-loops so they're always in the state
+        rtrs = torch.tensor(self.routers, dtype=torch.long)
+        self.router_loops = torch.stack([rtrs, rtrs])
+
+        # Nodes that are in the state no matter what the transient edges are
+        static = torch.cat([self.permenant_edges, self.router_loops], dim=1).flatten()
+        self.static_nodes = torch.zeros(int(static.max())+1, dtype=torch.bool)
+        self.static_nodes[static] = True
+        self._index_key = None
+        self._index = None
+
+    def _node_index(self):
+        '''
+        Nodes in the state (sorted, same as unique() over all the edges
+        would give) and the remap from nids to their row in the state.
+        Only rebuilt when a node is added to or dropped from the graph.
+        Also returns whether the old remap is still right for the nodes
+        that were already there (i.e. new nodes only went on the end)
+        '''
+        te = self.transient_edges
+        key = (te.node_version, self._conn_extra)
+        if self._index_key == key:
+            return self._index[0], self._index[1], True
+
+        n = max(self.feats.x.size(0), self.static_nodes.size(0))
+        present = torch.zeros(n, dtype=torch.bool)
+        present[:self.static_nodes.size(0)] = self.static_nodes
+        present[self.subnet_connectivity.flatten()] = True
+        deg = te.deg[:n]
+        present[:deg.size(0)] |= deg > 0
+        nids = present.nonzero().squeeze(-1)
+
+        remap = torch.full((max(n, te.deg.size(0)),), -1, dtype=torch.long)
+        remap[nids] = torch.arange(nids.size(0))
+
+        old = self._index[0] if self._index is not None else None
+        valid = (
+            self._index_key is not None and
+            old.size(0) <= nids.size(0) and
+            torch.equal(nids[:old.size(0)], old)
+        )
+
+        self._index = (nids, remap, remap[self.permenant_edges], remap[self.router_loops])
+        self._index_key = key
+        return nids, remap, valid
+
     def _remap_sn_mask(self, k, remap):
         '''
         Update masks so when state is reindexed, masks still point
         to the same nodes 
-        '''
-        (srv,usr,edge,rtrs) = self.subnet_masks[k]
 
-        return (
-            torch.tensor([remap[s] for s in srv]),
-            torch.tensor([remap[u] for u in usr]),
-            torch.tensor([
-                [remap[e] for e in edge[0]],
-                [remap[e] for e in edge[1]]
-            ]),
-            torch.tensor([remap[r] for r in rtrs])
-        )
+        Args:
+            k: subnet name
+            remap: tensor s.t. remap[old_nid] == new_nid
+        '''
+        return tuple(remap[m] for m in self.subnet_masks[k])
 
     def get_state(self, subnets):
         '''
@@ -233,49 +626,48 @@ class ObservationGraph:
             subnets: list of routers we want observations w.r.t (strings)
         '''
 
-        # Cat all edges together
-        ei = torch.tensor([
-            self.permenant_edges[0] + self.transient_edges[0] + self.subnet_connectivity[0] + self.routers,
-            self.permenant_edges[1] + self.transient_edges[1] + self.subnet_connectivity[1] + self.routers
-        ])
-
-        # Reindex so we use smallest possible feature vector 
-        nids, ei = ei.unique(return_inverse=True)
-        nid_map = {n.item():i for i,n in enumerate(nids)}
-
-        # Create mapping from old nids to reindexed nids 
-        nodes = [self.nodes[n.item()] for n in nids]
-        ntypes = [self.NTYPES[type(n)] for n in nodes]
-
-        # Add features for subnet membership
-        rtr_map = {r:i for i,r in enumerate(self.routers)}
-        transductive_routers = torch.zeros(nids.size(0), 9)
-
-        x = torch.zeros(nids.size(0), self.DIM-9)
-        for i,node in enumerate(nodes):
-            # Get one-hot ntype feature
-            ntype = ntypes[i]
-            x[i][ntype] = 1.
-
-            # Label which subnet it's in
-            name = self.nids.id_to_str(nids[i].item())
-            sn = name[:name.index('subnet') + 6] + '_router'
-            sn = self.nids[sn]
-            transductive_routers[i, rtr_map[sn]] = 1
-
-            # Get multi-dim feature (if node has features)
-            if node.dim:
-                offset = self.OFFSETS[ntype]
-                x[i][offset : offset + node.dim] = torch.from_numpy(node.get_features())
-
-        x = torch.cat([x, transductive_routers], dim=1)
+        # Only nodes that changed since last call need new features.
+        # Everything else is just a lookup
+        self._update_features()
+        nids, remap, valid = self._node_index()
+        x = self.feats.x[nids]
+
+        # Swap in rows for the nodes this fork replaced
+        if self._own_ids.size(0):
+            rows = remap[self._own_ids]
+            here = rows >= 0
+            x[rows[here]] = self.own_feats.x[self._own_ids[here]]
+
+        # Renumbered edges. Transient ones are kept renumbered in the
+        # edge store, so usually only the newest few need remapping
+        ei = torch.cat([
+            self._index[2],
+            self.transient_edges.compacted(remap, valid),
+            remap[self.subnet_connectivity],
+            self._index[3]
+        ], dim=1)
 
         # Remap masks s.t. we know which nodes we are interested in doing
         # actions upon 
-        masks = [self._remap_sn_mask(sn,nid_map) for sn in subnets]
+        masks = [self._remap_sn_mask(sn,remap) for sn in subnets]
         return x,ei,masks
 
 
+    def _age_ephemeral(self):
+        '''
+        Remove edges to ephemeral ports that haven't been seen 
+        in the last `self.max_ephemeral_age` steps
+        '''
+        expired = [
+            nid for nid,t in self.ephemeral_seen.items()
+            if self.ts - t > self.max_ephemeral_age
+        ]
+
+        if expired:
+            self.transient_edges.remove_nodes(expired)
+            for nid in expired:
+                self.ephemeral_seen.pop(nid)
+
     def parse_initial_observation(self, obs):
         '''
         Converts from initial dictionary observation describing 
@@ -296,7 +688,7 @@ class ObservationGraph:
             if 'router' in hostname:
                 nid = self.nids[hostname]
                 routers.append(nid)
-                self.nodes[nid] = SystemNode(nid, info, is_router=True)
+                self._set_node(nid, SystemNode(nid, info, is_router=True))
                 self.subnet_to_router[info['Interface'][0]['Subnet']] = nid
                 continue
 
@@ -311,7 +703,7 @@ class ObservationGraph:
             else:
                 is_server = False
 
-            self.nodes[nid] = SystemNode(nid, info['System info'], is_server)
+            self._set_node(nid, SystemNode(nid, info['System info'], is_server))
 
             # Add edge from host to subnet router
             for sub in info['Interface']:
@@ -350,11 +742,11 @@ class ObservationGraph:
                     # increases episode generation time by about 20s 
                     conn['process_name'] = proc['process_name']
                     conn['process_type'] = proc['process_type']
-                    self.nodes[pid] = ConnectionNode(pid, conn, is_default=True)
+                    self._set_node(pid, ConnectionNode(pid, conn, is_default=True))
 
         # Create special internet node
         nid = self.nids['internet_subnet_router']
-        self.nodes[nid] = InternetNode(nid)
+        self._set_node(nid, InternetNode(nid))
         routers.append(nid)
         self.routers = routers
 
@@ -383,26 +775,14 @@ class ObservationGraph:
 
             # Need to remove host related edges, and any ports it may
             # have opened to talk to other nodes
-            host_ports = [
-                k for (k,v) in self.nids.inv_mapping.items()
-                if v.startswith(act.hostname) and k != host_id
-            ]
+            host_ports = self.nids.children(act.hostname)
 
             removed = [host_id] + host_ports
 
-            # Cycle through existing edges and remove any with 
-            # restored host as src or dst 
-            new_edges = [[],[]]
-            for i in range(len(self.transient_edges[0])):
-                src = self.transient_edges[0][i]
-                dst = self.transient_edges[1][i]
-
-                if src not in removed and dst not in removed:
-                    new_edges[0].append(src)
-                    new_edges[1].append(dst)
+            # Remove any existing edges with restored host as src or dst 
+            self.transient_edges.remove_nodes(removed)
 
             # Remove restored host from list of suspicious machines
-            self.transient_edges = new_edges
             if act.hostname in self.host_to_sussy:
                 self.host_to_sussy.pop(act.hostname)
 
@@ -414,15 +794,7 @@ class ObservationGraph:
                 sus_ids = []
 
             if sus_ids:
-                new_edges = [[],[]]
-                for i in range(len(self.transient_edges[0])):
-                    if  (src := self.transient_edges[0][i]) not in sus_ids and \
-                        (dst := self.transient_edges[1][i]) not in sus_ids:
-
-                        new_edges[0].append(src)
-                        new_edges[1].append(dst)
-
-                self.transient_edges = new_edges
+                self.transient_edges.remove_nodes(sus_ids)
 
         elif isinstance(act, DeployDecoy) and success == TernaryEnum.TRUE:
             # Have to parse out which decoy was selected using the
@@ -438,9 +810,8 @@ class ObservationGraph:
 
             # Add edge from port -> host representing external communication
             # being allowed to enter the host through this node
-            self.nodes[port_id] = init_decoy(port_id, service)
-            self.transient_edges[0].append(port_id)
-            self.transient_edges[1].append(host_id)
+            self._set_node(port_id, init_decoy(port_id, service))
+            self.transient_edges.append([port_id], [host_id])
 
 
         edges = set()
@@ -484,24 +855,28 @@ class ObservationGraph:
                         lp_name = f'{local_host}:{local_port}'
                         lp_id = self.nids[lp_name]
 
-                        if local_port > 49152 or self.nodes.get(lp_id) is None:
+                        if local_port > 49152 or self._get_node(lp_id) is None:
                             # Just make a new node
                             lp_node = ConnectionNode(lp_id, is_ephemeral=local_port > 49152)
-                            self.nodes[lp_id] = lp_node
+                            self._set_node(lp_id, lp_node)
 
-                        self.transient_edges[0] += [rh_id, lp_id]
-                        self.transient_edges[1] += [lp_id, lh_id]
+                        if local_port > 49152:
+                            self.ephemeral_seen[lp_id] = self.ts
+
+                        self.transient_edges.append([rh_id, lp_id], [lp_id, lh_id])
 
                     if remote_port:
                         rp_name = f'{remote_host}:{remote_port}'
                         rp_id = self.nids[rp_name]
 
-                        if remote_port > 49152 or self.nodes.get(rp_id) is None:
+                        if remote_port > 49152 or self._get_node(rp_id) is None:
                             rp_node = ConnectionNode(rp_id, is_ephemeral=remote_port > 49152)
-                            self.nodes[rp_id] = rp_node
+                            self._set_node(rp_id, rp_node)
+
+                        if remote_port > 49152:
+                            self.ephemeral_seen[rp_id] = self.ts
 
-                        self.transient_edges[0] += [lh_id, rp_id]
-                        self.transient_edges[1] += [rp_id, rh_id]
+                        self.transient_edges.append([lh_id, rp_id], [rp_id, rh_id])
 
                     # Seems like this only happens if proc is suspicious?
                     if 'PID' in proc:
@@ -513,7 +888,7 @@ class ObservationGraph:
                 for file in files:
                     file_uq_str = f"{hostname}:{file['Path']}\\{file['File Name']}"
                     file_id = self.nids[file_uq_str]
-                    self.nodes[file_id] = FileNode(file_id, file)
+                    self._set_node(file_id, FileNode(file_id, file))
 
                     edges.update([
                         (host_id, file_id),
@@ -522,8 +897,11 @@ class ObservationGraph:
 
         if edges:
             src,dst = zip(*edges)
-            self.transient_edges[0] += src
-            self.transient_edges[1] += dst
+            self.transient_edges.append(src, dst)
+
+        self.ts += 1
+        if self.max_ephemeral_age is not None:
+            self._age_ephemeral()
 
         # Need to put it back in the dict now that we're done with it
         obs['success'] = success
\ No newline at end of file
@@ -0,0 +1,53 @@
+from CybORG.Agents.Wrappers.CybermonicWrappers.graph_wrapper import GraphWrapper
+
+class VecGraphWrapper:
+    '''
+    Steps several GraphWrapper envs in lockstep so one process can batch
+    every agent's observation across all of them into a single forward
+    pass (see cage4.get_actions). Envs that finish an episode are reset
+    automatically, and the observation returned for them is the first
+    one of the new episode.
+    '''
+    def __init__(self, envs: list[GraphWrapper], episode_len=None):
+        self.envs = envs
+
+        # Treat an env as done after this many steps, even if CybORG
+        # hasn't said so itself
+        self.episode_len = episode_len
+        self.last_obs = None
+
+    def __len__(self):
+        return len(self.envs)
+
+    def reset(self):
+        self.last_obs = [env.reset()[0] for env in self.envs]
+        return self.last_obs
+
+    def step(self, actions):
+        '''
+        Args:
+            actions: list of action dicts, one per env, in the same
+                     format GraphWrapper.step takes
+
+        Returns list of observations, list of reward dicts, and a list of
+        bools for which envs finished their episode (and were reset)
+        '''
+        if self.last_obs is None:
+            self.reset()
+
+        obs, rewards, dones = [],[],[]
+        for env,action in zip(self.envs, actions):
+            o,r,term,trunc,_ = env.step(action)
+
+            done = any(term.values()) or any(trunc.values())
+            if self.episode_len is not None:
+                done = done or env.ts >= self.episode_len
+            if done:
+                o,_ = env.reset()
+
+            obs.append(o)
+            rewards.append(r)
+            dones.append(done)
+
+        self.last_obs = obs
+        return obs, rewards, dones
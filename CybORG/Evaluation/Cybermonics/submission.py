@@ -12,10 +12,10 @@ import torch
 from CybORG.Shared.MetricsCallback import MetricsCallback
 
 ### Import custom agents here ###
-from CybORG.Agents.CybermonicAgents.cage4 import load
+from CybORG.Agents.CybermonicAgents.cage4 import InductiveGraphPPOAgent, load
 from CybORG.Agents.Wrappers.CybermonicWrappers.graph_wrapper import GraphWrapper
 
-from CybORG.Agents.LLMAgents.llm_agent import DefenderAgent, RLLib_shim
+from CybORG.Agents.LLMAgents.llm_agent import DefenderAgent, RLLib_shim, prefetch_actions
 from CybORG.Agents.LLMAgents.llm_policy import LLMDefenderPolicy
 from CybORG.Agents.LLMAgents.comm_vector import CommVectorGenerator as cvg
 from CybORG.Shared.Enums import TernaryEnum
@@ -57,6 +57,16 @@ class Submission:
         return CombinedWrapper(env)
 
     
+def mirror_symmetric(agents: dict) -> bool:
+    """Whether the GNN agents were trained on mirrored observations (--share-weights).
+    
+    They all see the same GraphWrapper, so they have to agree.
+    """
+    flags = {agent.mirror_symmetric for agent in agents.values() if isinstance(agent, InductiveGraphPPOAgent)}
+    if len(flags) > 1:
+        raise ValueError("Mix of mirrored (--share-weights) and unmirrored GNN checkpoints")
+    return flags.pop() if flags else False
+
 class CombinedWrapper(BaseWrapper):
     def __init__(self, env):
         super().__init__(env)
@@ -68,7 +78,9 @@ class CombinedWrapper(BaseWrapper):
 
         # Create separate wrapped environments for different agents
         self.phase_wrapper = PhaseWrapper(phase_env)  # Only used for blue_agent_0
-        self.graph_wrapper = GraphWrapper(graph_env)  # Used for blue_agent_1 to blue_agent_4
+        self.graph_wrapper = GraphWrapper(  # Used for blue_agent_1 to blue_agent_4
+            graph_env, mirror_symmetric=mirror_symmetric(Submission.AGENTS)
+        )
 
     def step(self, actions):
         """Ensures the correct wrapper processes each agent's step."""
@@ -112,6 +124,9 @@ class CombinedWrapper(BaseWrapper):
         truncated = {**graph_trunc, **phase_trunc}
         info = {**graph_info, **phase_info}
 
+        # Get all the LLM agents thinking about their next action at the same time
+        prefetch_actions(Submission.AGENTS, observations)
+
         return observations, rewards, terminated, truncated, info
 
     def reset(self, *args, **kwargs):
@@ -134,6 +149,7 @@ class CombinedWrapper(BaseWrapper):
             info = {**graph_info, **phase_info}  
 
         self.metrics_callback.on_reset(self.phase_wrapper.env)
+        prefetch_actions(Submission.AGENTS, observations)
 
         return observations, info
     
@@ -10,7 +10,7 @@ import wandb
 
 # Import your custom agents here.
 from dummy_agent import ReactRemoveBlueAgent
-from CybORG.Agents.LLMAgents.llm_agent import DefenderAgent, RLLib_shim
+from CybORG.Agents.LLMAgents.llm_agent import DefenderAgent, RLLib_shim, prefetch_actions
 from CybORG.Agents.LLMAgents.llm_policy import LLMDefenderPolicy
 from CybORG.Shared.MetricsCallback import MetricsCallback
 
@@ -64,6 +64,9 @@ class PhaseWrapper(BaseWrapper):
         info = {}
 
         self.metrics_callback.on_reset(self.env)
+
+        # Get all the LLM agents thinking about their next action at the same time
+        prefetch_actions(Submission.AGENTS, observations)
         
         return observations, info
 
@@ -108,6 +111,8 @@ class PhaseWrapper(BaseWrapper):
         terminated = {agent: done for agent, done in dones.items() if "blue" in agent}
         truncated = {agent: done for agent, done in dones.items() if "blue" in agent}
 
+        prefetch_actions(Submission.AGENTS, observations)
+
         return observations, rewards, terminated, truncated, {}
 
     def action_space(self, agent_name: str) -> Space:
@@ -0,0 +1,289 @@
+from argparse import ArgumentParser
+from collections import defaultdict
+from functools import wraps
+import json
+import resource
+import subprocess
+import time
+
+import torch
+
+import cybermonic_train as ct
+from cybermonic_train import HYPER_PARAMS, MAX_THREADS, N_AGENTS, SEED, generate_episode_job, make_env
+
+from CybORG.Agents.Wrappers.EnterpriseMAE import EnterpriseMAE
+from CybORG.Agents.CybermonicAgents import cage4
+from CybORG.Agents.CybermonicAgents.cage4 import InductiveGraphPPOAgent, load
+from CybORG.Agents.CybermonicAgents.memory_buffer import MultiPPOMemory
+from CybORG.Agents.Wrappers.CybermonicWrappers.graph_wrapper import GraphWrapper
+from CybORG.Agents.Wrappers.CybermonicWrappers.observation_graph import ObservationGraph
+from CybORG.Agents.Wrappers.CybermonicWrappers.vec_wrapper import VecGraphWrapper
+
+class StageTimer:
+    '''
+    Wraps functions so every call adds to the total time of a stage.
+    Times are exclusive: if one timed function calls another, the inner
+    call only counts towards its own stage (e.g. get_state called from
+    inside get_actions when a LazyObs is read)
+    '''
+    def __init__(self):
+        self.total = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.stack = []
+
+    def wrap(self, owner, name, stage):
+        fn = getattr(owner, name)
+
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            self.stack.append(0.)
+            st = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - st
+                child = self.stack.pop()
+                self.total[stage] += elapsed - child
+                self.calls[stage] += 1
+                if self.stack:
+                    self.stack[-1] += elapsed
+
+        setattr(owner, name, timed)
+
+    def reset(self):
+        self.total.clear()
+        self.calls.clear()
+
+def instrument(timer):
+    '''
+    Stages of generate_episode_job. Anything not covered ends up in 'other'
+    '''
+    timer.wrap(EnterpriseMAE, 'step', 'env_step')
+    timer.wrap(GraphWrapper, 'reset', 'env_reset')
+    timer.wrap(ObservationGraph, 'parse_observation', 'parse_observation')
+    timer.wrap(GraphWrapper, '_parse_tabular', 'parse_tabular')
+    timer.wrap(ObservationGraph, 'get_state', 'get_state')
+    timer.wrap(GraphWrapper, '_combine_data', 'build_obs')
+    timer.wrap(GraphWrapper, '_to_obs', 'build_obs')
+    timer.wrap(GraphWrapper, 'step', 'wrapper_other')
+    timer.wrap(cage4, 'combine_marl_states', 'combine_states')
+    timer.wrap(InductiveGraphPPOAgent, '_forward', 'forward')
+    timer.wrap(ct, 'get_actions', 'get_actions_other')
+    timer.wrap(MultiPPOMemory, 'remember', 'memory')
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+def build_agents(args):
+    if args.checkpoint:
+        agents = [load(f'{args.checkpoint}-{i}_checkpoint.pt') for i in range(N_AGENTS)]
+
+        # Need values/log probs like during training
+        for agent in agents:
+            agent.training = True
+        return agents
+
+    return [InductiveGraphPPOAgent(
+        ObservationGraph.DIM+5,
+        a_kwargs={'hidden1': args.hidden, 'hidden2': args.embedding},
+        c_kwargs={} if args.shared_trunk else {'hidden1': args.hidden, 'hidden2': args.embedding},
+        amp=args.amp,
+        compiled=args.compile,
+        shared_trunk=args.shared_trunk
+    ) for _ in range(N_AGENTS)]
+
+def benchmark(args):
+    torch.manual_seed(args.seed)
+
+    hp = HYPER_PARAMS
+    hp.episode_len = args.episode_len
+    hp.envs_per_worker = args.envs
+    hp.dedup_edges = args.dedup_edges
+    hp.max_ephemeral_age = args.max_ephemeral_age
+    # generate_episode_job uses MAX_THREADS // workers threads
+    hp.workers = max(1, MAX_THREADS // args.threads)
+
+    agents = build_agents(args)
+
+    # Checkpoints trained with --share-weights need mirrored observations
+    hp.share_weights = any(agent.mirror_symmetric for agent in agents)
+    venv = VecGraphWrapper(
+        [make_env(hp, seed=args.seed + n) for n in range(args.envs)],
+        episode_len=hp.episode_len
+    )
+
+    timer = StageTimer()
+    instrument(timer)
+
+    # Untimed warmup (first reset, compilation, lazy allocations)
+    for _ in range(args.warmup):
+        generate_episode_job(agents, venv, hp, 0)
+
+    timer.reset()
+    st = time.perf_counter()
+    for i in range(args.episodes):
+        generate_episode_job(agents, venv, hp, i)
+    wall = time.perf_counter() - st
+
+    steps = args.episodes * args.envs * hp.episode_len
+    stages = dict(timer.total)
+    stages['other'] = max(0., wall - sum(stages.values()))
+
+    return {
+        'commit': git_commit(),
+        'config': vars(args),
+        'steps': steps,
+        'wall_s': wall,
+        'steps_per_sec': steps / wall,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'stages': {
+            k: {
+                'total_s': v,
+                'ms_per_step': 1000 * v / steps,
+                'frac': v / wall,
+                'calls': timer.calls.get(k, 0)
+            }
+            for k,v in sorted(stages.items(), key=lambda x : -x[1])
+        }
+    }
+
+def variant(agent, **kwargs):
+    '''
+    Copy of agent with the same weights, but different amp/compiled settings
+    '''
+    args, a_kwargs = agent.args, dict(agent.kwargs)
+    a_kwargs.update(kwargs)
+    out = InductiveGraphPPOAgent(*args, **a_kwargs)
+    out.actor.load_state_dict(agent.actor.state_dict())
+    out.critic.load_state_dict(agent.critic.state_dict())
+    return out
+
+def timed_forward(agent, state, reps):
+    '''
+    Time of the first call (includes compilation) and mean of the next reps calls
+    '''
+    with torch.no_grad():
+        st = time.perf_counter()
+        dist, value = agent._forward(state)
+        first = time.perf_counter() - st
+
+        st = time.perf_counter()
+        for _ in range(reps):
+            agent._forward(state)
+        steady = (time.perf_counter() - st) / reps
+
+    return dist.probs, value, first, steady
+
+def check(args):
+    '''
+    Compare compiled and bf16 autocast agents against the eager one (same 
+    weights) on states from a real rollout, for a rollout-sized batch (one 
+    state per agent) and a learn()-sized minibatch. Fails if action probs
+    or values are further than the tolerance from eager. Also reports how 
+    long the first (compiling) call takes, and how many calls it takes 
+    to earn that back.
+    '''
+    torch.manual_seed(args.seed)
+    hp = HYPER_PARAMS
+    hp.episode_len = args.episode_len
+    hp.envs_per_worker = 1
+    hp.dedup_edges = args.dedup_edges
+    hp.max_ephemeral_age = args.max_ephemeral_age
+    hp.workers = max(1, MAX_THREADS // args.threads)
+
+    # Checks always start from eager fp32, whatever the other flags say
+    args.amp = args.compile = False
+    agents = build_agents(args)
+    hp.share_weights = any(agent.mirror_symmetric for agent in agents)
+    venv = VecGraphWrapper([make_env(hp, seed=args.seed)], episode_len=hp.episode_len)
+    mems = generate_episode_job(agents, venv, hp, 0)[0][0]
+
+    variants = {
+        'compiled': dict(compiled=True),
+        'amp': dict(amp=True),
+        'amp+compiled': dict(amp=True, compiled=True),
+    }
+    tolerance = {'compiled': args.atol_compile, 'amp': args.atol_amp, 'amp+compiled': args.atol_amp}
+
+    ok = True
+    results = []
+    for i in (0, N_AGENTS-1):   # Single-subnet and multi-subnet agents
+        eager = agents[i]
+        s = mems[i].s
+        shapes = {
+            'rollout': s[torch.tensor([0])],
+            'learn': s[torch.arange(min(args.learn_bs, len(s)))],
+        }
+
+        for shape, state in shapes.items():
+            ref_p, ref_v, _, eager_t = timed_forward(eager, state, args.reps)
+            for name, kwargs in variants.items():
+                torch._dynamo.reset()
+                p, v, first, steady = timed_forward(variant(eager, **kwargs), state, args.reps)
+
+                dp = (p - ref_p).abs().max().item()
+                dv = (v - ref_v).abs().max().item()
+                passed = max(dp, dv) <= tolerance[name]
+                ok = ok and passed
+
+                # Calls needed for the compile time to pay for itself
+                saved = eager_t - steady
+                breakeven = (first - steady) / saved if saved > 0 else float('inf')
+
+                results.append(dict(
+                    agent=i, shape=shape, variant=name, max_dprob=dp, max_dvalue=dv, passed=passed,
+                    first_call_s=first, eager_ms=eager_t*1000, variant_ms=steady*1000, breakeven_calls=breakeven
+                ))
+                print(
+                    f"agent {i} {shape:<8} {name:<13} max|dp| {dp:.2e} max|dv| {dv:.2e} "
+                    f"{'ok' if passed else 'FAIL'}  first call {first:6.2f}s  "
+                    f"{eager_t*1000:7.2f}ms -> {steady*1000:7.2f}ms  (break even after {breakeven:.0f} calls)"
+                )
+
+    return ok, results
+
+if __name__ == '__main__':
+    ap = ArgumentParser(description='Time episode generation (SleepAgent blue, FiniteStateRedAgent, EnterpriseGreenAgent)')
+    ap.add_argument('--episodes', action='store', type=int, default=2, help='Timed episodes (per env)')
+    ap.add_argument('--warmup', action='store', type=int, default=1, help='Untimed episodes to run first')
+    ap.add_argument('--episode-len', action='store', type=int, default=HYPER_PARAMS.episode_len)
+    ap.add_argument('--envs', action='store', type=int, default=1, help='Envs stepped in lockstep (VecGraphWrapper)')
+    ap.add_argument('--threads', action='store', type=int, default=1, help='Torch threads')
+    ap.add_argument('--seed', action='store', type=int, default=SEED)
+    ap.add_argument('--checkpoint', action='store', default=None, help='Use weights from checkpoints/<this>-i_checkpoint.pt instead of random init')
+    ap.add_argument('--hidden', action='store', type=int, default=256)
+    ap.add_argument('--embedding', action='store', type=int, default=128)
+    ap.add_argument('--shared-trunk', action='store_true')
+    ap.add_argument('--amp', action='store_true')
+    ap.add_argument('--compile', action='store_true')
+    ap.add_argument('--dedup-edges', action='store_true')
+    ap.add_argument('--max-ephemeral-age', action='store', type=int, default=None)
+    ap.add_argument('--out', action='store', default=None, help='Write JSON results here (otherwise just print)')
+    ap.add_argument('--check', action='store_true', help='Instead of timing episodes, check --compile/--amp outputs against eager')
+    ap.add_argument('--atol-compile', action='store', type=float, default=1e-5)
+    ap.add_argument('--atol-amp', action='store', type=float, default=1e-2, help='bf16 is only good to ~3 digits')
+    ap.add_argument('--learn-bs', action='store', type=int, default=HYPER_PARAMS.bs, help='Minibatch size for --check')
+    ap.add_argument('--reps', action='store', type=int, default=10, help='Timed calls per shape for --check')
+    args = ap.parse_args()
+
+    if args.check:
+        ok, results = check(args)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump({'commit': git_commit(), 'config': vars(args), 'passed': ok, 'results': results}, f, indent=2)
+        exit(0 if ok else 1)
+
+    results = benchmark(args)
+
+    print(f"{results['steps']} steps in {results['wall_s']:0.2f}s ({results['steps_per_sec']:0.1f} steps/s), peak RSS {results['peak_rss_mb']:0.0f}MB")
+    for k,v in results['stages'].items():
+        print(f"  {k:<20} {v['ms_per_step']:8.3f} ms/step  {100*v['frac']:5.1f}%")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -4,8 +4,10 @@ from types import SimpleNamespace
 
 from joblib import Parallel, delayed
 import torch
+import torch.multiprocessing as mp
 from tqdm import tqdm
 import time
+import queue
 
 import wandb
 
@@ -13,135 +15,394 @@ from CybORG import CybORG
 from CybORG.Agents import SleepAgent, EnterpriseGreenAgent, FiniteStateRedAgent
 from CybORG.Simulator.Scenarios import EnterpriseScenarioGenerator
 
-from CybORG.Agents.CybermonicAgents.cage4 import InductiveGraphPPOAgent
-from CybORG.Agents.CybermonicAgents.memory_buffer import MultiPPOMemory
+from CybORG.Agents.CybermonicAgents.cage4 import InductiveGraphPPOAgent, get_actions
+from CybORG.Agents.CybermonicAgents.memory_buffer import MultiPPOMemory, TrajectoryWriter
 from CybORG.Agents.Wrappers.CybermonicWrappers.graph_wrapper import GraphWrapper
+from CybORG.Agents.Wrappers.CybermonicWrappers.vec_wrapper import VecGraphWrapper
 from CybORG.Agents.Wrappers.CybermonicWrappers.observation_graph import ObservationGraph
 
 SEED = 1337
 HYPER_PARAMS = SimpleNamespace(
     N = 25,             # How many episodes before training
-    workers = 25,       # How many envs can run in parallel
+    workers = 25,       # How many rollout processes to run in parallel
+    envs_per_worker = 1,    # How many envs each worker steps in lockstep
     bs = 2500,          # How many steps to learn from at a time
     episode_len = 500,
     training_episodes = 50_000, # Realistically, stops improving around 50k
-    epochs = 4
+    epochs = 4,
+    dedup_edges = False,        # Only keep one copy of each observed edge
+    max_ephemeral_age = None,   # Steps before unseen ephemeral ports are dropped
+    async_rollouts = False,     # Keep generating episodes while the learner updates
+    max_staleness = 1,          # Drop episodes from policies more than this many updates old
+    learner_procs = False,      # Run each agent's update in its own process instead of a thread
+    share_weights = False,      # Agents 0/2 and 1/3 share networks (see SYMMETRIC)
+    record = None               # Directory to save every episode's memories to
 )
 
 N_AGENTS = 5 
+
+# Agents 0/2 and 1/3 defend identical subnets (restricted zones and
+# operational zones of the two deployed networks), so they can share a network
+SYMMETRIC = {2: 0, 3: 1}
 MAX_THREADS = 36 # 5 per subnet (20 for agent 4, 4 for all others)
 torch.manual_seed(SEED)
 torch.set_num_threads(MAX_THREADS)
 
 @torch.no_grad()
-def generate_episode_job(agents, env, hp, i):
+def generate_episode_job(agents, venv, hp, i):
     '''
-    Per-process job to generate one episode of memories
-    for all 5 agents. Returns `N_AGENTS` memory buffers, 
-    and the total reward for the episode. 
+    Per-process job to generate one episode of memories for all 5 
+    agents in each of the envs in `venv`. All envs are stepped in 
+    lockstep so each agent's observations from every env get batched 
+    into one forward pass. Returns a list with `N_AGENTS` memory buffers
+    and the total reward for each env's episode. 
 
     Args: 
         agents:     list of keep.cage4.InductiveGraphAgent objects 
-        env:        wrapped cyborg object 
+        venv:       VecGraphWrapper over the worker's envs
         hp:         hyperparameter namespace 
         i:          process id in range(0, `hp.workers`)
     '''
     torch.set_num_threads(MAX_THREADS // hp.workers)
 
-    # Initialize environment
-    env.reset()
-    states = env.last_obs
-    blocked_rewards = [0]*N_AGENTS
+    # Envs are reset automatically at the end of each episode, so only
+    # the first job needs to do it 
+    states = venv.last_obs if venv.last_obs is not None else venv.reset()
+    n_envs = len(venv)
+    blocked_rewards = [[0]*N_AGENTS for _ in range(n_envs)]
 
-    tot_reward = 0
-    memory_buffers = MultiPPOMemory(hp.bs)
+    tot_rewards = [0]*n_envs
+    memory_buffers = [MultiPPOMemory(hp.bs) for _ in range(n_envs)]
 
     # Begin episode 
     for ts in tqdm(range(hp.episode_len), desc=f'Worker {i}'):
-        actions = dict()
-        memories = dict()
-
-        # Get actions for all unblocked agents
-        for k,(state,blocked) in states.items():
-            i = int(k[-1])
-            if blocked:
-                actions[k] = None
+        actions = [dict() for _ in range(n_envs)]
+        memories = [dict() for _ in range(n_envs)]
+
+        # Get actions for all unblocked agents in every env
+        obs = {(n,k):s for n,env_states in enumerate(states) for k,s in env_states.items()}
+        out = get_actions({(n,k):agents[int(k[-1])] for n,k in obs}, obs)
+        for (n,k),o in out.items():
+            agent_idx = int(k[-1])
+            if o is None:
+                actions[n][k] = None
             else:
-                action,value,prob = agents[i].get_action((state,blocked))
-                memories[i] = (state,action,value,prob)
-                actions[k] = action
+                action,value,prob = o
+                memories[n][agent_idx] = (obs[n,k][0],action,value,prob)
+                actions[n][k] = action
+
+        next_state, rewards, dones = venv.step(actions)
+
+        for n in range(n_envs):
+            env_rewards = list(rewards[n].values())
+            tot_rewards[n] += sum(env_rewards)/N_AGENTS
+
+            # Delay recieving rewards until multi-step actions are completed. 
+            # Agents recieve cumulative reward for all the timesteps 
+            # they spent performing their action. 
+            for agent_idx in range(N_AGENTS):
+                if agent_idx in memories[n]:
+                    s,a,v,p = memories[n][agent_idx]
+                    r = env_rewards[agent_idx] + blocked_rewards[n][agent_idx]
+                    t = int(dones[n] or ts == hp.episode_len-1)
+
+                    memory_buffers[n].remember(agent_idx, s,a,v,p, r,t)
+                    blocked_rewards[n][agent_idx] = 0
+                else:
+                    blocked_rewards[n][agent_idx] += env_rewards[agent_idx]
 
-        next_state, rewards, _,_,_ = env.step(actions)
-        rewards = list(rewards.values())
-        tot_reward += sum(rewards)/N_AGENTS
+        states = next_state
 
-        # Delay recieving rewards until multi-step actions are completed. 
-        # Agents recieve cumulative reward for all the timesteps 
-        # they spent performing their action. 
-        for i in range(N_AGENTS):
-            if i in memories:
-                s,a,v,p = memories[i]
-                r = rewards[i] + blocked_rewards[i]
-                t = 0 if ts < hp.episode_len-1 else 1
+    # Agents that were mid-action on the last step never stored a terminal
+    # memory. Mark their last one so returns don't leak across episodes 
+    for buff in memory_buffers:
+        for mem in buff.mems:
+            if mem.t:
+                mem.t[-1] = 1
+
+    return [(buff.mems, r) for buff,r in zip(memory_buffers, tot_rewards)]
+
+def make_env(hp, seed=SEED):
+    sg = EnterpriseScenarioGenerator(
+        blue_agent_class=SleepAgent,
+        green_agent_class=EnterpriseGreenAgent,
+        red_agent_class=FiniteStateRedAgent,
+        steps=hp.episode_len,
+    )
+    env = CybORG(sg, "sim", seed=seed)
+    return GraphWrapper(
+        env,
+        dedup_edges=hp.dedup_edges,
+        max_ephemeral_age=hp.max_ephemeral_age,
+        mirror_symmetric=hp.share_weights
+    )
 
-                memory_buffers.remember(i, s,a,v,p, r,t)
-                blocked_rewards[i] = 0
-            else:
-                blocked_rewards[i] += rewards[i]
+def share_weights(agent):
+    '''
+    Copies the actor/critic weights into shared memory so rollout 
+    workers can read the current policy without it being pickled 
+    and sent to them every iteration 
+    '''
+    return {
+        name: {k: v.detach().clone().share_memory_() for k,v in getattr(agent, name).state_dict().items()}
+        for name in ('actor', 'critic')
+    }
 
-        states = next_state
+def publish_weights(agent, shared):
+    '''
+    Overwrite the shared buffers with the agent's updated weights. 
+    Only called between iterations, while the workers are idle
+    '''
+    for name,sd in shared.items():
+        for k,v in getattr(agent, name).state_dict().items():
+            sd[k].copy_(v)
+
+def load_weights(agent, shared):
+    agent.actor.load_state_dict(shared['actor'])
+    agent.critic.load_state_dict(shared['critic'])
+
+def thread_budget(ids):
+    '''
+    How many threads a network shared by agents `ids` gets for backprop. 
+    Use more threads for Agent 4 because they're managing 3 subnets 
+    instead of 1 (bigger graph/matrices). Still not perfectly 
+    load-balanced, but close enough
+    '''
+    return sum(
+        MAX_THREADS // 9 if i < 4 else (MAX_THREADS // 9) * N_AGENTS
+        for i in ids
+    )
+
+def expand_groups(group_agents, groups):
+    '''
+    Turn one agent per group back into a list of `N_AGENTS` agents 
+    where agents in the same group are the same object 
+    '''
+    agents = [None] * N_AGENTS
+    for agent,ids in zip(group_agents, groups):
+        for i in ids:
+            agents[i] = agent
+    return agents
+
+def learner_worker(g, ids, agent_args, shared, cores, jobs, done):
+    '''
+    Long-lived learner process for one network (shared by agents `ids`). 
+    Owns the agent (and its optimizer state) for the whole run, so only
+    memories go in and only weights come out. Since `torch.set_num_threads` 
+    is per-process, each learner can keep its own budget without fighting 
+    the others over it. A `None` job shuts it down. 
 
-    return memory_buffers.mems, tot_reward
+    Args: 
+        g:          group id 
+        ids:        agent ids that use this network 
+        agent_args: (args, kwargs) to rebuild the agent 
+        shared:     shared weight dict from `share_weights` to publish 
+                    updated weights to 
+        cores:      list of cpu ids to pin the process to (or None)
+        jobs:       queue of memory lists (one PPOMemory per episode)
+        done:       queue to send (g, loss) back on once weights are published
+    '''
+    torch.set_num_threads(thread_budget(ids))
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    args,kwargs = agent_args
+    agent = InductiveGraphPPOAgent(*args, **kwargs)
+    load_weights(agent, shared)
+    agent.train()
+
+    while (mems := jobs.get()) is not None:
+        agent.memory.mems = mems
+        loss = agent.learn()
+        publish_weights(agent, shared)
+        done.put((g, loss))
+
+def rollout_worker(wid, agent_args, shared, groups, version, hp, seed, tasks, results):
+    '''
+    Long-lived rollout process. Builds its envs and agents once, then 
+    generates `hp.envs_per_worker` episodes for every index it pulls off 
+    the task queue, using whatever weights are in shared memory at the 
+    time. A `None` task shuts it down. Results are tagged with the policy 
+    version they were generated with. 
+
+    Args: 
+        wid:        worker id in range(0, `hp.workers`)
+        agent_args: list of (args, kwargs) to rebuild each group's agent 
+        shared:     list of shared weight dicts from `share_weights`
+        groups:     list of agent ids that share each network
+        version:    shared int counting how many times weights were published
+        hp:         hyperparameter namespace
+        seed:       base seed. Offset per env so workers don't all 
+                    play out the same episode 
+        tasks:      queue of episode indices (first of each chunk)
+        results:    queue to send (idx, memories, reward, version) back on
+    '''
+    k = hp.envs_per_worker
+    torch.manual_seed(seed + wid)
+    venv = VecGraphWrapper(
+        [make_env(hp, seed=seed + wid*k + n) for n in range(k)],
+        episode_len=hp.episode_len
+    )
+    group_agents = [InductiveGraphPPOAgent(*args, **kwargs) for args,kwargs in agent_args]
+    agents = expand_groups(group_agents, groups)
+
+    while (i := tasks.get()) is not None:
+        # Lock so the learner can't publish halfway through a load 
+        with version.get_lock():
+            for agent,sd in zip(group_agents, shared):
+                load_weights(agent, sd)
+            v = version.value
+
+        out = generate_episode_job(agents, venv, hp, i)
+        for n,(mems,reward) in enumerate(out):
+            results.put((i+n, mems, reward, v))
 
 def train(agents, hp, seed=SEED):
     [agent.train() for agent in agents]
     log = []
 
-    # Only call constructors once out here to save some time
-    envs = []
-    for i in range(min(hp.workers, hp.N)):
-        sg = EnterpriseScenarioGenerator(
-            blue_agent_class=SleepAgent,
-            green_agent_class=EnterpriseGreenAgent,
-            red_agent_class=FiniteStateRedAgent,
-            steps=hp.episode_len,
+    # Start rollout workers once. Each one owns `hp.envs_per_worker` envs
+    # for the whole run, and pulls new weights out of shared memory 
+    # every episode 
+    assert hp.N % hp.envs_per_worker == 0, 'N must be a multiple of envs_per_worker'
+
+    # Agents that are the same object (see --share-weights) are one 
+    # network, trained once per iteration on all of their memories 
+    groups = dict()
+    for i,agent in enumerate(agents):
+        groups.setdefault(id(agent), []).append(i)
+    groups = list(groups.values())
+    group_agents = [agents[ids[0]] for ids in groups]
+
+    shared = [share_weights(agent) for agent in group_agents]
+    agent_args = [(agent.args, agent.kwargs) for agent in group_agents]
+
+    ctx = mp.get_context('spawn')
+    version = ctx.Value('i', 0)
+    tasks, results = ctx.Queue(), ctx.Queue()
+    workers = [
+        ctx.Process(
+            target=rollout_worker,
+            args=(w, agent_args, shared, groups, version, hp, seed, tasks, results),
+            daemon=True
         )
-        env = CybORG(sg, "sim", seed=seed)
-        envs.append(GraphWrapper(env))
+        for w in range(min(hp.workers, hp.N // hp.envs_per_worker))
+    ]
+    [w.start() for w in workers]
+
+    # Save trajectories for offline training later 
+    # (load with memory_buffer.TrajectoryDataset)
+    if hp.record:
+        writers = [TrajectoryWriter(os.path.join(hp.record, f'agent_{i}')) for i in range(N_AGENTS)]
+
+    # Episodes that have been asked for but not recieved yet 
+    outstanding = 0
+    next_idx = 0
+    def request(n):
+        nonlocal outstanding, next_idx
+        while outstanding < n:
+            tasks.put(next_idx)
+            next_idx += hp.envs_per_worker
+            outstanding += hp.envs_per_worker
 
     # Define learn function for threads to call later so we can 
-    # parallelize the backprop step. Use more threads for Agent 4 
-    # because they're managing 3 subnets instead of 1 (bigger graph/matrices)
-    # Still not perfectly load-balanced, but close enough
-    def learn(i):
-            if i < 4:
-                torch.set_num_threads(MAX_THREADS // 9)
-            else:
-                torch.set_num_threads((MAX_THREADS // 9) * N_AGENTS)
-            return agents[i].learn()
+    # parallelize the backprop step. 
+    def learn(g):
+            torch.set_num_threads(thread_budget(groups[g]))
+            return group_agents[g].learn()
+
+    # Or, give each network its own learner process pinned to its own
+    # set of cores. They get their own copy of the weights so rollout
+    # workers never see an update until it's published below 
+    learners = []
+    if hp.learner_procs:
+        learner_shared = [share_weights(agent) for agent in group_agents]
+        learner_jobs = [ctx.Queue() for _ in groups]
+        updates = ctx.Queue()
+
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+        offset = 0
+        for g,ids in enumerate(groups):
+            n = thread_budget(ids)
+            cores = cpus[offset:offset+n] if offset+n <= len(cpus) else None
+            offset += n
+
+            learners.append(ctx.Process(
+                target=learner_worker,
+                args=(g, ids, agent_args[g], learner_shared[g], cores, learner_jobs[g], updates),
+                daemon=True
+            ))
+        [l.start() for l in learners]
 
     # Begin training loop 
     for e in range(hp.training_episodes // hp.N):
         e *= hp.N
 
-        # Generate N episodes in parallel 
-        out = Parallel(prefer='processes', n_jobs=hp.workers)(
-            delayed(generate_episode_job)(agents, envs[i % len(envs)], hp, i) for i in range(hp.N)
-        )
+        # Generate N episodes in parallel. In async mode some may have been
+        # generated by older weights, so throw out any that are too stale 
+        out = []
+        dropped = 0
+        while len(out) < hp.N:
+            request(hp.N - len(out))
+            res = results.get()
+            outstanding -= 1
+
+            if version.value - res[-1] <= hp.max_staleness:
+                out.append(res)
+            else:
+                dropped += 1
+        out = sorted(out, key=lambda x : x[0])
+
+        # Let workers get started on the next batch with the current 
+        # weights while the learner updates 
+        if hp.async_rollouts:
+            request(hp.N)
 
         # Concat memories across episodes, and transfer them to agents' 
         # internal memory buffers 
-        memories, avg_rewards = zip(*out)
+        _, memories, avg_rewards, versions = zip(*out)
+        staleness = version.value - sum(versions) / hp.N
         memories = [list(m) for m in zip(*memories)]
-        for i in range(N_AGENTS):
-            agents[i].memory.mems = memories[i]
+        if hp.record:
+            for i in range(N_AGENTS):
+                writers[i].write(memories[i])
+
+        # Shared networks learn from every episode of all their agents
+        memories = [sum((memories[i] for i in ids), []) for ids in groups]
 
-        # Use threads because agents are in heap memory 
-        # Parallel backpropagation 
         print("Updating")
-        last_losses = Parallel(prefer='threads', n_jobs=N_AGENTS)(
-            delayed(learn)(i) for i in range(N_AGENTS)
-        )
+        group_losses = [0]*len(groups)
+        if hp.learner_procs:
+            for g in range(len(groups)):
+                learner_jobs[g].put(memories[g])
+
+            for _ in groups:
+                g,loss = updates.get()
+                group_losses[g] = loss
+
+            # Keep local copies current for checkpointing/publishing
+            for agent,sd in zip(group_agents, learner_shared):
+                load_weights(agent, sd)
+
+        else:
+            for g in range(len(groups)):
+                group_agents[g].memory.mems = memories[g]
+
+            # Use threads because agents are in heap memory 
+            # Parallel backpropagation 
+            group_losses = Parallel(prefer='threads', n_jobs=len(groups))(
+                delayed(learn)(g) for g in range(len(groups))
+            )
+
+        last_losses = [0]*N_AGENTS
+        for ids,loss in zip(groups, group_losses):
+            for i in ids:
+                last_losses[i] = loss
+
+        with version.get_lock():
+            for agent,sd in zip(group_agents, shared):
+                publish_weights(agent, sd)
+            version.value += 1
 
         losses = ','.join([f'{last_losses[i]:0.4f}' for i in range(N_AGENTS)])
         print(f"[{e}] Loss: [{losses}]")
@@ -149,12 +410,16 @@ def train(agents, hp, seed=SEED):
         # Log average reward across all episodes 
         avg_reward = sum(avg_rewards) / hp.N
         print(f"Avg reward for episode: {avg_reward}")
+        if hp.async_rollouts:
+            print(f"Avg staleness: {staleness:0.2f} ({dropped} episodes dropped)")
         log.append((avg_reward,e,sum(last_losses)/N_AGENTS))
         torch.save(log, f'logs/{hp.fnames}.pt')
         wandb.log(
             {
                 "reward": avg_reward,
-                "loss": sum(last_losses)/N_AGENTS
+                "loss": sum(last_losses)/N_AGENTS,
+                "staleness": staleness,
+                "dropped": dropped
             },
             step=e
         )
@@ -167,12 +432,48 @@ def train(agents, hp, seed=SEED):
             if e % 10_000 < hp.N and e > hp.N:
                 agent.save(outf=f'checkpoints/{hp.fnames}-{i}_{e//1000}k.pt')
 
+    # Don't bother finishing episodes nobody is going to learn from
+    try:
+        while True:
+            tasks.get_nowait()
+    except queue.Empty:
+        pass
+
+    for _ in workers:
+        tasks.put(None)
+
+    # Workers can't exit until whatever they've queued up gets read 
+    while any(w.is_alive() for w in workers):
+        try:
+            results.get(timeout=1)
+        except queue.Empty:
+            pass
+    [w.join() for w in workers]
+
+    for g,l in enumerate(learners):
+        learner_jobs[g].put(None)
+    [l.join() for l in learners]
+
 
 if __name__ == '__main__':
     ap = ArgumentParser()
     ap.add_argument('fname', help='Required: the name to save output files as.')
     ap.add_argument('--hidden', action='store', type=int, default=256, help='Dimension of middle layer for actor/critic')
     ap.add_argument('--embedding', action='store', type=int, default=128, help='Dimension of node representation for actor/critic')
+    ap.add_argument('--workers', action='store', type=int, default=HYPER_PARAMS.workers, help='Number of rollout processes')
+    ap.add_argument('--envs-per-worker', action='store', type=int, default=HYPER_PARAMS.envs_per_worker, help='Envs each rollout process steps together (batched inference)')
+    ap.add_argument('--gae', action='store_true', help='Use GAE(lambda) advantages instead of normalized returns')
+    ap.add_argument('--async-rollouts', action='store_true', help='Keep generating episodes with slightly stale weights while the learner updates')
+    ap.add_argument('--max-staleness', action='store', type=int, default=HYPER_PARAMS.max_staleness, help='Drop episodes generated by weights more than this many updates old')
+    ap.add_argument('--shared-trunk', action='store_true', help='Critic is a head on the actor\'s GNN instead of its own network')
+    ap.add_argument('--amp', action='store_true', help='Run actor/critic under bfloat16 autocast')
+    ap.add_argument('--compile', action='store_true', help='torch.compile actor/critic forward passes')
+    ap.add_argument('--share-weights', action='store_true', help='Agents 0/2 and 1/3 share one network each, trained on both agents\' memories')
+    ap.add_argument('--record', action='store', default=None, help='Directory to save all rollouts to (one chunk per agent per update)')
+    ap.add_argument('--learner-procs', action='store_true', help='Run each agent\'s update in its own (pinned) process instead of a thread')
+    ap.add_argument('--vtrace', action='store_true', help='Use V-trace targets to correct for stale episodes')
+    ap.add_argument('--dedup-edges', action='store_true', help='Only keep one copy of each transient edge in the observation graph')
+    ap.add_argument('--max-ephemeral-age', action='store', type=int, default=None, help='Drop ephemeral port nodes not observed for this many steps')
     ap.add_argument(
         "--wandb-mode", type=str, default="offline", help="Mode for wandb logging (offline, online)"
     )
@@ -206,12 +507,31 @@ if __name__ == '__main__':
         ObservationGraph.DIM+5,
         bs=HYPER_PARAMS.bs,
         a_kwargs={'lr': 0.0003, 'hidden1': args.hidden, 'hidden2': args.embedding},
-        c_kwargs={'lr': 0.001, 'hidden1': args.hidden, 'hidden2': args.embedding},
+        c_kwargs={'lr': 0.001} if args.shared_trunk else {'lr': 0.001, 'hidden1': args.hidden, 'hidden2': args.embedding},
         clip=0.2,
-        epochs=HYPER_PARAMS.epochs
+        epochs=HYPER_PARAMS.epochs,
+        gae=args.gae,
+        vtrace=args.vtrace,
+        amp=args.amp,
+        compiled=args.compile,
+        shared_trunk=args.shared_trunk,
+        mirror_symmetric=args.share_weights
     ) for _ in range(N_AGENTS)]
 
+    if args.share_weights:
+        for i,j in SYMMETRIC.items():
+            agents[i] = agents[j]
+
     HYPER_PARAMS.fnames = args.fname
+    HYPER_PARAMS.workers = args.workers
+    HYPER_PARAMS.envs_per_worker = args.envs_per_worker
+    HYPER_PARAMS.async_rollouts = args.async_rollouts
+    HYPER_PARAMS.learner_procs = args.learner_procs
+    HYPER_PARAMS.share_weights = args.share_weights
+    HYPER_PARAMS.record = args.record
+    HYPER_PARAMS.max_staleness = args.max_staleness
+    HYPER_PARAMS.dedup_edges = args.dedup_edges
+    HYPER_PARAMS.max_ephemeral_age = args.max_ephemeral_age
     start_time = time.time()
     train(agents, HYPER_PARAMS)
     end_time = time.time()
@@ -0,0 +1,92 @@
+from copy import deepcopy
+
+from CybORG.Shared.Enums import TernaryEnum
+from CybORG.Simulator.Actions.ConcreteActions.DecoyActions import DeployDecoy
+
+from CybORG.Agents.Wrappers.CybermonicWrappers.globals import ROUTERS, MY_SUBNETS
+from CybORG.Agents.Wrappers.CybermonicWrappers.observation_graph import ObservationGraph
+
+DECOYED = 'restricted_zone_a_subnet_server_host_0'
+OBSERVER = 'operational_zone_a_subnet_user_host_0'
+
+def initial_observation():
+    '''
+    Smallest network ObservationGraph.setup accepts: a router, a server
+    and a user host (each with ssh open) on every subnet
+    '''
+    obs = {'success': TernaryEnum.UNKNOWN}
+    for i,router in enumerate(ROUTERS):
+        if router == 'internet_subnet_router':
+            continue
+
+        sn = router.replace('_router', '')
+        cidr = f'10.0.{i}.0/24'
+        obs[router] = {'Interface': [{'ip_address': f'10.0.{i}.1', 'Subnet': cidr}]}
+        for j,host in enumerate([f'{sn}_server_host_0', f'{sn}_user_host_0']):
+            ip = f'10.0.{i}.{j+2}'
+            obs[host] = {
+                'Interface': [{'ip_address': ip, 'Subnet': cidr}],
+                'System info': {},
+                'Processes': [{
+                    'process_name': None, 'process_type': None,
+                    'Connections': [{'local_port': 22, 'local_address': ip}]
+                }]
+            }
+
+    obs['root_internet_host_0'] = {'Interface': [{'ip_address': '10.0.99.1', 'Subnet': 'internet'}]}
+    return obs
+
+def named_features(g, subnets):
+    '''
+    Feature row of every node in the state, by node name (nids are
+    handed out in a different order by forks and deep copies)
+    '''
+    x,ei,_ = g.get_state(subnets)
+    nids,_,_ = g._node_index()
+    return {g.nids.id_to_str(nid): x[i] for i,nid in enumerate(nids.tolist())}
+
+def test_fork_decoy_not_shared():
+    init = initial_observation()
+    g = ObservationGraph()
+    g.setup(deepcopy(init))
+
+    # What every agent used to get: its own deep copy of the graph
+    base_a, base_b = deepcopy(g), deepcopy(g)
+    fork_a, fork_b = g.fork(), g.fork()
+
+    # Agent A deploys an apache2 decoy (port 80) on a server
+    deploy = lambda: {
+        'success': TernaryEnum.TRUE,
+        'action': DeployDecoy(session=0, agent='blue_agent_0', hostname=DECOYED),
+        DECOYED: {'Processes': [{'service_name': 'apache2'}]}
+    }
+
+    # Agent B sees one of its hosts connect to that port
+    connect = lambda: {
+        'success': TernaryEnum.UNKNOWN,
+        OBSERVER: {'Processes': [{'Connections': [{
+            'local_address': init[OBSERVER]['Interface'][0]['ip_address'],
+            'local_port': 50000,
+            'remote_address': init[DECOYED]['Interface'][0]['ip_address'],
+            'remote_port': 80
+        }]}]}
+    }
+
+    for a,b in [(base_a, base_b), (fork_a, fork_b)]:
+        a.parse_observation(deploy())
+        b.parse_observation(connect())
+
+    port = f'{DECOYED}:80'
+    for sns in [MY_SUBNETS[0], MY_SUBNETS[1]]:
+        for base,fork in [(base_a, fork_a), (base_b, fork_b)]:
+            expected = named_features(base, sns)
+            actual = named_features(fork, sns)
+            assert expected.keys() == actual.keys()
+            for name in expected:
+                assert (expected[name] == actual[name]).all(), name
+
+    # Sanity check that the decoy is actually in A's state, and B's differs
+    feats_a = named_features(fork_a, MY_SUBNETS[0])
+    feats_b = named_features(fork_b, MY_SUBNETS[1])
+    assert port in feats_a and port in feats_b
+    assert not (feats_a[port] == feats_b[port]).all()